@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+import aiohttp
+import asyncio
+import time
+
+from concurrent.futures import CancelledError
+from threading import Thread, get_ident
+
+from bot import Bot, observe_call
+
+
+# Bot on an asyncio event loop. polling and every api call, messages
+# included, run as tasks on one loop served by its own thread, so a slow
+# request no longer holds a thread. the blocking parts, command handlers,
+# refresh and state writes, run on the loop's executor, where botq() stays
+# synchronous for them and for the admin cache threads
+class AsyncBot(Bot):
+    pooled_sends = False
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = Thread(target=self.loop.run_forever, daemon=True)
+        self.loop_thread.start()
+        self.http = None
+        self.main = None
+        super(AsyncBot, self).__init__()
+
+    def on_loop(self):
+        return get_ident() == self.loop_thread.ident
+
+    # runs a coroutine on the loop from any other thread
+    def call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def abotq(self, method, params=None, timeout=None):
+        if not self.http:
+            self.http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size))
+
+        timeout = timeout or self.timeout
+        # form values are sent as text, the same way requests encodes them
+        params = {k: str(v) for k, v in (params or {}).items()}
+        start = time.perf_counter()
+        try:
+            async with self.http.post(
+                    self.api + method, data=params,
+                    timeout=aiohttp.ClientTimeout(sock_connect=timeout[0],
+                                                  sock_read=timeout[1])) as res:
+                r = await res.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            print('{0} failed: {1}'.format(method, e))
+            r = {'ok': False, 'description': str(e)}
+
+        observe_call(method, start, r)
+        return r
+
+    # waiting on the loop from the loop itself would never return
+    def botq(self, method, params=None, timeout=None):
+        if self.on_loop():
+            raise RuntimeError('botq({0}) called on the event loop, '
+                               'await abotq() instead'.format(method))
+        return self.call(self.abotq(method, params, timeout)).result()
+
+    # the scheduler gets a future, no thread waits for the response
+    def send_message(self, params):
+        return self.call(self.abotq('sendMessage', params, self.send_timeout))
+
+    # runs blocking code on the loop's executor
+    async def blocking(self, fn, *args):
+        return await self.loop.run_in_executor(None, fn, *args)
+
+    async def get_updates(self):
+        params, timeout = self.poll_request()
+        r = await self.abotq('getUpdates', params, timeout)
+
+        if not r.get('ok') or not self.running:
+            return False
+
+        await self.blocking(self.process_updates, r['result'])
+        return True
+
+    async def poll(self):
+        while self.running:
+            # nothing new is taken before the last batch is written
+            if self.uncommitted and not await self.blocking(
+                    self.commit_updates):
+                await asyncio.sleep(1)
+
+            # updates are pushed, or polled by another replica
+            elif self.push or not self.leader:
+                await asyncio.sleep(1)
+
+            # back off a bit when telegram is unreachable
+            elif not await self.get_updates():
+                await asyncio.sleep(1)
+
+    async def run_refresh(self):
+        while not self.stopped.is_set():
+            await asyncio.sleep(self.refresh_interval)
+            await self.blocking(self.refresh_leader)
+
+    def refresh_leader(self):
+        with self.lock:
+            if self.leader:
+                self.refresh()
+
+    async def serve(self):
+        await asyncio.gather(self.poll(), self.run_refresh())
+
+    def run_threaded(self):
+        self.running = True
+        self.stopped.clear()
+        self.start_updates()
+        self.main = self.call(self.serve())
+        return self.main
+
+    def run(self):
+        try:
+            self.run_threaded().result()
+        except CancelledError:
+            pass
+
+    # the long poll in flight is cancelled instead of waited for
+    def stop(self):
+        super(AsyncBot, self).stop()
+        if self.main:
+            self.main.cancel()
+
+    def close(self):
+        super(AsyncBot, self).close()
+        if self.http:
+            self.call(self.http.close()).result(5)
@@ -1,15 +1,37 @@
 #!/usr/bin/env python3
 
-import atexit
+import hmac
+import json
+import random
 import re
 import signal
+import sqlite3
 import time
 
-from flask import Flask, request, jsonify
+from threading import Event, Thread
+
+from flask import Flask, Response, request, jsonify
+from werkzeug.serving import make_server
 
 from bot import Bot
-from formatters import eventFormatters as fmt
-from util import digest, dumpjson, new_secret, strange, tdif, timestamp as ts
+from cache import AdminCache, Dedup
+from digest import Digest
+from expiry import Expiry
+from formatters import esc, eventFormatters as fmt
+from metrics import SIZES, metrics
+from outbox import Outbox
+from registry import ChatRegistry
+from render import budget, truncate
+from router import Router, event_route
+from util import digest, dumpjson, headjson, new_secret, strange, tdif,\
+    timestamp as ts
+from workqueue import AsyncWorkQueue, WorkQueue
+
+# orjson decodes large payloads several times faster when it's installed
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
 
 
 # formatted string from a dictionary
@@ -41,8 +63,16 @@ def msg(*args):
         'chat_deauth': "\U0001F60E Ok, deauthorized!",
         'chat_leave': "I'll leave in {0} minutes if I'm not requested before.",
         'chat_unauth': "\U0001F612 go away.",
+        'chat_wait': "Still looking up this chat's admins, try again in a moment",
         'chat_quiet': "Going quiet now \U0001F910",
         'chat_unknown': "I don't know that chat \U0001F914",
+        'sub_list': "Here's what this chat gets:\n```\n{0}```\n",
+        'sub_all': "This chat gets every event, use /sub to filter",
+        'sub_new': "Ok! Subscribed to {0} events of {1} on branch {2}",
+        'sub_remove': "Ok! Deleted {0} subscription{1}",
+        'dead_list': "Here's the list of undelivered messages:\n```\n{0}```\n",
+        'dead_requeue': "Ok! Requeued {0} message{1}",
+        'outbox_off': "The outbox is disabled",
         'owner_list': "Here's the list of bot owners:\n```\n{0}```\n",
         'owner_remove': "Ok! {0} owner{1} gone",
         'bot_auth': "\U0001F60E You're the boss!",
@@ -50,88 +80,215 @@ def msg(*args):
     }.get(args[0], args[0]).format(*args[1:])
 
 
+fanout_size = metrics.histogram('broadcast_chats',
+                                'Chats each broadcast fans out to',
+                                buckets=SIZES)
+refresh_seconds = metrics.histogram('refresh_seconds',
+                                    'Time spent expiring and refreshing')
+
+
 class GitlabBot(Bot):
     def __init__(self):
         self.configFile = 'config.json'
         super(GitlabBot, self).__init__()
 
+        admins = self.config.get('admins', {})
+        self.refresh_jitter = admins.get('jitter', 0.2)
+        self.admins = AdminCache(self.get_chat_admins, self.admins_updated,
+                                 admins.get('ttl', 60 * self.defaults.get(
+                                     'chat_lifetime', 1)),
+                                 self.refresh_jitter,
+                                 admins.get('workers', 4))
+
+        outbox = self.config.get('outbox', {})
+        self.outbox = None
+        if outbox.get('enabled', True):
+            self.outbox = Outbox(outbox.get('path', 'outbox.db'), self.reply,
+                                 outbox.get('attempts', 5),
+                                 outbox.get('backoff', 2),
+                                 outbox.get('backoff_max', 600))
+            self.outbox.start()
+
+        self.load_state()
+
+        # replicas come and go behind the leader without telling the chats.
+        # chats due for a refresh are picked by the refresh thread
+        if not self.clustered:
+            Thread(target=self.broadcast, args=(msg('online'),),
+                   daemon=True).start()
+
+    # views and indexes over self.state, rebuilt when a replica reloads it
+    def load_state(self):
         self.owners = self.state.get('owners', [])
-        self.chats = self.state.get('chats', [])
-        self.otp = self.state.get('otp', [])
+        self.chats = ChatRegistry(self.state.get('chats', []))
+        # tokens and challenges by expiry key, in the order they were made.
+        # they're written back to the state lists by dump_state()
+        self.otp = {self.expiry_key('otp', o): o
+                    for o in self.state.get('otp', [])}
+        self.challenges = {self.expiry_key('chg', c): c
+                           for c in self.state.get('challenges', [])}
         self.state['owners'] = self.owners
-        self.state['chats'] = self.chats
-        self.state['otp'] = self.otp
-
-        self.challenges = []
+        self.state['chats'] = self.chats.chats
+
+        self.router = Router(self.chats)
+
+        self.expiry = Expiry()
+        for o in self.otp.values():
+            self.expire('otp', o)
+        for c in self.challenges.values():
+            self.expire('chg', c)
+        for c in self.chats:
+            self.expire('chat', c)
+
+    def dump_state(self):
+        self.state['otp'] = list(self.otp.values())
+        self.state['challenges'] = list(self.challenges.values())
+
+    # chat ids subscribed to the event
+    def route(self, event, data):
+        with self.lock:
+            return self.router.route(event, *event_route(event, data))
+
+    # fans out to every active chat, returns the send futures by chat id.
+    # `source` is the inbox entry of the event the message comes from
+    # `sources` are the inbox ids of the events the message comes from
+    def broadcast(self, m, chats=None, sources=()):
+        if not m:
+            if self.outbox:
+                self.outbox.post([], sources)
+            return {}
+
+        def done(cid, f):
+            r = f.result()
+            if not r.get('ok'):
+                print('Broadcast to {0} failed: {1} {2}'
+                      .format(cid, r.get('error_code', ''),
+                              r.get('description', '')))
+
+        targets = self.chats if chats is None\
+            else filter(None, map(self.chats.get, chats))
+
+        targets = [c['id'] for c in targets
+                   if c['authorized'] and not c['quiet']]
+        if self.outbox:
+            sends = dict(zip(targets, self.outbox.post(
+                [(cid, m) for cid in targets], sources)))
+        else:
+            sends = {cid: self.reply(cid, m) for cid in targets}
+        fanout_size.observe(len(sends))
 
-        self.broadcast(msg('online'))
+        for cid, f in sends.items():
+            f.add_done_callback(lambda f, cid=cid: done(cid, f))
 
-    def broadcast(self, m):
-        if m:
-            for c in self.chats:
-                if c['authorized'] and not c['quiet']:
-                    self.reply(c['id'], m)
+        return sends
 
     def user_entry(self, u):
         return {'id': u['id'],
                 'name': u.get('username', u.get('name', u.get('title', '')))}
 
+    # owner and admins come from the admin cache, a stale or missing list
+    # is refreshed in the background and applied by admins_updated()
     def update_chat(self, c):
-        c['admins'] = []
-
         if c['type'] == 'private':
+            c['admins'] = []
             c['owner'] = self.user_entry(c)
-            return
 
-        for a in self.get_chat_admins(c):
-            if (a['status'] == 'administrator' and a['can_promote_members']):
-                c['admins'].append = self.user_entry(a['user'])
+        else:
+            admins = self.admins.get(c)
+            if admins is None:
+                return
+
+            c['admins'] = []
+            for a in admins:
+                if (a['status'] == 'administrator'
+                        and a.get('can_promote_members')):
+                    c['admins'].append(self.user_entry(a['user']))
 
-            elif a['status'] == 'creator':
-                c['owner'] = self.user_entry(a['user'])
+                elif a['status'] == 'creator':
+                    c['owner'] = self.user_entry(a['user'])
+
+        self.chats.reindex(c)
+
+    def admins_updated(self, cid):
+        with self.lock:
+            c = self.chats.get(cid)
+            if c:
+                self.update_chat(c)
+                self.save_config()
+
+    def expiry_key(self, kind, o):
+        return {
+            'chg': lambda: ('chg', o['cid'], o['uid']),
+            'otp': lambda: ('otp', o['secret'], o['type']),
+            'chat': lambda: ('chat', o['id'])
+        }[kind]()
+
+    # (re)schedules the entry at its current refresh timestamp
+    def expire(self, kind, o):
+        self.expiry.schedule(self.expiry_key(kind, o), o)
+
+    # removes a challenge or token right away
+    def drop(self, kind, o):
+        key = self.expiry_key(kind, o)
+        self.expiry.cancel(key)
+        {'chg': self.challenges, 'otp': self.otp}[kind].pop(key, None)
+
+    # challenge by (cid, uid) or token by (secret, type). one that expired
+    # since the last refresh is dropped instead of returned
+    def pending(self, *key):
+        o = self.expiry.get(key)
+        if o and o['refresh'] < int(time.time()):
+            self.drop(key[0], o)
+            return None
+        return o
 
     def refresh(self):
+        with refresh_seconds.time():
+            self.expire_due()
+
+    def expire_due(self):
         save_config = False
 
-        def iter(f, xs):
-            for i, x in enumerate(xs):
-                if f(x):
-                    del xs[i]
-                    nonlocal save_config
-                    save_config = True
+        for key, o in self.expiry.due(int(time.time())):
+            save_config = True
 
-        def expired(o):
-            return int(time.time()) > o['refresh']
+            if key[0] == 'chg':
+                self.challenges.pop(key, None)
 
-        def chat(c):
-            if (not c['authorized']) and expired(c):
-                self.botq('leaveChat', {'chat_id': c['id']})
-                return True
+            elif key[0] == 'otp':
+                self.otp.pop(key, None)
 
-            if (not c['authorized']) or expired(c):
-                self.update_chat(c)
-                if c['authorized']:
-                    c['refresh'] = ts(self.defaults.get('chat_lifetime', 1))
-                nonlocal save_config
-                save_config = True
+            elif not o['authorized']:
+                self.botq('leaveChat', {'chat_id': o['id']})
+                self.chats.remove(o)
+                self.router.invalidate()
 
-        iter(expired, self.challenges)
-        iter(expired, self.otp)
-        iter(chat, self.chats)
+            else:
+                self.update_chat(o)
+                o['refresh'] = self.chat_refresh()
+                self.expire('chat', o)
 
         if save_config:
             self.save_config()
 
+    # chats cached together would otherwise refetch their admins in the
+    # same tick on every refresh
+    def chat_refresh(self):
+        lifetime = 60 * self.defaults.get('chat_lifetime', 1)
+        return int(time.time() + lifetime * (1 + random.uniform(
+            -self.refresh_jitter, self.refresh_jitter)))
+
     def cache_chat(self, c):
-        cached = next((cc for cc in self.chats if cc['id'] == c['id']), None)
+        cached = self.chats.get(c['id'])
         if cached:
             return cached
 
-        c['refresh'] = ts(self.defaults.get('chat_lifetime', 1))
+        c['refresh'] = self.chat_refresh()
         c['authorized'] = False
         c['quiet'] = True
-        self.chats.append(c)
+        self.chats.add(c)
         self.update_chat(c)
+        self.expire('chat', c)
         return c
 
     def msg_recv(self, m):
@@ -139,12 +296,21 @@ class GitlabBot(Bot):
 
         if 'text' in m:
             self.txt_recv(m['text'], chat, m.get('from', m.get('sender_chat', '')))
-            self.save_config()
+            # commands may authorize, quiet or (un)subscribe chats. the
+            # state is written once for the whole batch
+            self.router.invalidate()
 
         elif 'new_chat_participant' in m\
              and m['new_chat_participant']['username'] == self.me['username']:
             self.cache_chat(chat)
 
+    # someone was promoted, demoted or left: drop the cached admin list
+    def member_recv(self, m):
+        c = self.chats.get(self.get_chat(m)['id'])
+        if c:
+            self.admins.invalidate(c['id'])
+            self.admins.refresh(c)
+
     def txt_recv(self, txt, chat, from_):
         args = (txt[1:] if txt.startswith('/') else txt).strip().split()
         cmd = re.sub(r'[^@]\([@][^ ]+\)$', '', args.pop(0))
@@ -156,28 +322,36 @@ class GitlabBot(Bot):
             if type(cid) is list:
                 cid = cid[0]
 
-            key = 'id'
             if type(cid) is str:
                 if cid[1:].isdecimal():
                     cid = int(cid)
                 else:
-                    key = 'name'
+                    return self.chats.named(cid)
 
-            return next((c for c in self.chats if c[key] == cid), None)
+            return self.chats.get(cid)
 
         def bot_owner():
             return any(owner['id'] == from_['id'] for owner in self.owners)
 
         def chat_owner(chat):
-            return self.cache_chat(chat)['owner']['id'] == from_['id']
+            owner = self.cache_chat(chat).get('owner', {})
+            return owner.get('id') == from_['id']
 
         def chat_admin(chat):
             return any(admin['id'] == from_['id']
-                       for admin in self.cache_chat(chat)['admins'])
+                       for admin in self.cache_chat(chat).get('admins', []))
 
         def is_privileged(chat):
             return bot_owner() or chat_owner(chat) or chat_admin(chat)
 
+        # the admins of a group seen for the first time are still on their
+        # way, that's no reason to turn anyone away
+        def unauth(chat):
+            c = self.cache_chat(chat)
+            if 'owner' not in c and self.admins.loading(c):
+                return msg('chat_wait')
+            return msg('chat_unauth')
+
         def check_args(min=0, max=0):
             if len(args) < min:
                 self.reply(chat, msg('arg_few'))
@@ -198,7 +372,7 @@ class GitlabBot(Bot):
 
         if cmd == 'lsotp':
             if check_owner_cmd():
-                self.reply(chat, msg('otp_list', dumpjson(self.otp)))
+                self.reply(chat, msg('otp_list', dumpjson(list(self.otp.values()))))
 
         elif cmd == 'getotp':
             if not check_owner_cmd(max=2):
@@ -224,7 +398,8 @@ class GitlabBot(Bot):
                 'type': type_ or self.defaults.get('otp_type', 'private'),
                 'refresh': ts(lifetime or self.defaults.get('otp_lifetime', 1))
             }
-            self.otp.append(otp)
+            self.otp[self.expiry_key('otp', otp)] = otp
+            self.expire('otp', otp)
             self.reply(chat, msg('otp_new', secret, otp['type'],
                                  tdif(otp['refresh'])))
 
@@ -236,21 +411,23 @@ class GitlabBot(Bot):
             if not r:
                 return self.reply(chat, msg('arg_extra', args[0]))
 
+            otps = list(self.otp.values())
             n = 0
-            for i in sorted(r, reverse=True):
-                if i < len(self.otp):
+            for i in r:
+                if i < len(otps):
                     n += 1
-                    del self.otp[i]
+                    self.drop('otp', otps[i])
             self.reply(chat, msg('otp_remove', n, '' if n == 1 else 's'))
 
         elif cmd == 'flushotp':
             if check_owner_cmd():
-                self.otp.clear()
+                for o in list(self.otp.values()):
+                    self.drop('otp', o)
                 self.reply(chat, msg('otp_flush'))
 
         elif cmd == 'lschg':
             if check_owner_cmd():
-                self.reply(chat, msg('chg_list', dumpjson(self.challenges)))
+                self.reply(chat, msg('chg_list', dumpjson(list(self.challenges.values()))))
 
         elif cmd == 'delchg':
             if not check_owner_cmd(min=1, max=1):
@@ -260,18 +437,46 @@ class GitlabBot(Bot):
             if not r:
                 return self.reply(chat, msg('arg_extra', args[0]))
 
+            chgs = list(self.challenges.values())
             n = 0
-            for i in sorted(r, reverse=True):
-                if i < len(self.challenges):
+            for i in r:
+                if i < len(chgs):
                     n += 1
-                    del self.challenges[i]
+                    self.drop('chg', chgs[i])
             self.reply(chat, msg('chg_remove', n, '' if n == 1 else 's'))
 
         elif cmd == 'flushchg':
             if check_owner_cmd():
-                self.challenges.clear()
+                for c in list(self.challenges.values()):
+                    self.drop('chg', c)
                 self.reply(chat, msg('chg_flush'))
 
+        elif cmd == 'lsdead':
+            if not check_owner_cmd():
+                return
+
+            if not self.outbox:
+                return self.reply(chat, msg('outbox_off'))
+
+            self.reply(chat, msg('dead_list', dumpjson(self.outbox.dead())))
+
+        elif cmd == 'requeue':
+            if not check_owner_cmd(min=1, max=1):
+                return
+
+            if not self.outbox:
+                return self.reply(chat, msg('outbox_off'))
+
+            r = strange(args[0])
+            if not r:
+                return self.reply(chat, msg('arg_extra', args[0]))
+
+            dead = self.outbox.dead()
+            ids = [dead[i]['id'] for i in r if i < len(dead)]
+            self.outbox.requeue(ids)
+            self.reply(chat, msg('dead_requeue', len(ids),
+                                 '' if len(ids) == 1 else 's'))
+
         elif cmd == 'lsowner':
             if check_owner_cmd():
                 self.reply(chat,
@@ -301,7 +506,7 @@ class GitlabBot(Bot):
                 return self.reply(chat, msg('chat_unknown'))
 
             if not is_privileged(tc):
-                return self.reply(chat, msg('chat_unauth'))
+                return self.reply(chat, unauth(tc))
 
             if (tc['authorized']):
                 return self.reply(chat, msg('chat_aauth'))
@@ -311,16 +516,15 @@ class GitlabBot(Bot):
                 tc['quiet'] = False
                 return self.reply(chat, msg('chat_auth'))
 
-            chg = next((c for c in self.challenges
-                        if c['cid'] == tc['id'] and c['uid'] == from_['id']),
-                       None)
+            chg = self.pending('chg', tc['id'], from_['id'])
             if not chg:
                 chg = {
                     'cid': tc['id'],
                     'uid': from_['id'],
                     'refresh': ts(self.defaults.get('challenge_lifetime', 1))
                 }
-                self.challenges.append(chg)
+                self.challenges[self.expiry_key('chg', chg)] = chg
+                self.expire('chg', chg)
 
             self.reply(chat, msg('chg_new', tdif(chg['refresh'])))
 
@@ -345,21 +549,16 @@ class GitlabBot(Bot):
             if not tc:
                 return self.reply(chat, msg('chat_unknown'))
 
-            otp = next((t for t in self.otp
-                        if t['secret'] == secret and t['type'] == 'owner'),
-                       None)
-
-            chg = next((c for c in self.challenges
-                        if c['cid'] == tc['id'] and c['uid'] == from_['id']),
-                       None)
+            otp = self.pending('otp', secret, 'owner')
+            chg = self.pending('chg', tc['id'], from_['id'])
 
             if (tc['id'] == chat['id'] and (otp or secret == digest(self.config['api_token']))):
                 if bot_owner():
                     return self.reply(chat, msg('bot_aauth'))
                 if otp:
-                    otp['refresh'] = 0
+                    self.drop('otp', otp)
                 if chg:
-                    chg['refresh'] = 0
+                    self.drop('chg', chg)
                 if tc['type'] != 'private':
                     tc['authorized'] = True
                 self.owners.append(self.user_entry(from_))
@@ -371,16 +570,14 @@ class GitlabBot(Bot):
             if not chg:
                 return self.reply(chat, msg('chg_unknown'))
 
-            otp = next((t for t in self.otp
-                        if t['secret'] == secret and t['type'] == tc['type']),
-                       None)
+            otp = self.pending('otp', secret, tc['type'])
             if not otp:
                 return self.reply(chat, msg('otp_bad_type'))
 
             tc['authorized'] = True
             tc['quiet'] = False
-            otp['refresh'] = 0
-            chg['refresh'] = 0
+            self.drop('otp', otp)
+            self.drop('chg', chg)
             return self.reply(chat, msg('chat_auth'))
 
         elif cmd == 'stop':
@@ -395,13 +592,14 @@ class GitlabBot(Bot):
                 tc['authorized'] = False
                 tc['quiet'] = True
                 tc['refresh'] = ts(10)
+                self.expire('chat', tc)
                 self.reply(chat, msg('chat_deauth'))
                 if tc['type'] != 'private':
                     self.reply(chat, msg('chat_leave', tdif(tc['refresh'])))
             elif bot_owner():
                 self.reply(chat, msg('sorry_owner'))
             else:
-                self.reply(chat, msg('chat_unauth'))
+                self.reply(chat, unauth(tc))
 
         elif cmd == 'lschat':
             if chat['type'] != 'private':
@@ -410,8 +608,8 @@ class GitlabBot(Bot):
             if not check_args():
                 return
 
-            chats = self.chats if bot_owner() else\
-                [c for c in self.chats if chat_owner(c) or chat_admin(c)]
+            chats = list(self.chats) if bot_owner() else\
+                self.chats.privileged(from_['id'])
 
             self.reply(chat, msg('chat_list', dumpjson(chats)))
 
@@ -427,7 +625,7 @@ class GitlabBot(Bot):
                 if bot_owner():
                     self.reply(chat, msg('sorry_owner'))
                 else:
-                    self.reply(chat, msg('chat_unauth'))
+                    self.reply(chat, unauth(tc))
             else:
                 tc['quiet'] = True
                 self.reply(chat, msg('chat_quiet'))
@@ -444,30 +642,251 @@ class GitlabBot(Bot):
                 if bot_owner():
                     self.reply(chat, msg('sorry_owner'))
                 else:
-                    self.reply(chat, msg('chat_unauth'))
+                    self.reply(chat, unauth(tc))
             else:
                 tc['quiet'] = False
                 self.reply(chat, msg('ok'))
 
+        elif cmd == 'sub':
+            if not check_args(min=1, max=3):
+                return
+
+            tc = target_chat()
+            if not is_privileged(tc):
+                return self.reply(chat, unauth(tc))
+
+            sub = dict(zip(['project', 'kind', 'branch'], args + ['*', '*']))
+            tc.setdefault('subs', []).append(sub)
+            # globs are full of markdown
+            self.reply(chat, msg('sub_new', esc(sub['kind']),
+                                 esc(sub['project']), esc(sub['branch'])))
+
+        elif cmd == 'unsub':
+            if not check_args(min=1, max=1):
+                return
+
+            tc = target_chat()
+            if not is_privileged(tc):
+                return self.reply(chat, unauth(tc))
+
+            r = strange(args[0])
+            if not r:
+                return self.reply(chat, msg('arg_extra', args[0]))
+
+            subs = tc.get('subs', [])
+            n = 0
+            for i in sorted(r, reverse=True):
+                if i < len(subs):
+                    n += 1
+                    del subs[i]
+            self.reply(chat, msg('sub_remove', n, '' if n == 1 else 's'))
+
+        elif cmd == 'lssub':
+            if not check_args():
+                return
+
+            tc = target_chat()
+            if not is_privileged(tc):
+                return self.reply(chat, unauth(tc))
+
+            if not tc.get('subs'):
+                return self.reply(chat, msg('sub_all'))
+
+            self.reply(chat, msg('sub_list', dumpjson(tc['subs'])))
+
         else:
             if is_privileged(chat):
                 return self.reply(chat, msg('cmd_unknown'))
 
             else:
-                return self.reply(chat, msg('chat_unauth'))
+                return self.reply(chat, unauth(chat))
+
+
+# the asyncio core is opt-in with "async": true, it needs aiohttp
+def new_bot():
+    with open('config.json', 'r') as cf:
+        if not json.load(cf).get('async'):
+            return GitlabBot()
+
+    from abot import AsyncBot
+
+    class AsyncGitlabBot(GitlabBot, AsyncBot):
+        pass
 
+    return AsyncGitlabBot()
 
-bot = GitlabBot()
+
+bot = new_bot()
 app = Flask(__name__)
 
 
-@app.route("/", methods=['GET', 'POST'])
-def webhook():
+webhook_requests = metrics.counter('webhook_requests_total',
+                                   'Webhook deliveries by event and status',
+                                   ('event', 'status'))
+webhook_seconds = metrics.histogram('webhook_seconds',
+                                    'Webhook intake latency', ('event',))
+format_seconds = metrics.histogram('format_seconds',
+                                   'Time spent formatting an event',
+                                   ('event',))
+
+
+# events without a formatter share a label, the name comes from the payload
+def event_label(event):
+    return event if event in fmt else 'other'
+
+
+digests = Digest(bot.broadcast, bot.config.get('digest', {}))
+dedup = Dedup(bot.config.get('dedup', {}).get('ttl', 3600),
+              bot.config.get('dedup', {}).get('size', 10000))
+
+
+# keys identifying an event across redeliveries, which repeat the body
+def event_keys(event, data, headers, raw):
+    uuid = headers.get('X-Gitlab-Event-UUID')
+    keys = ['uuid:' + uuid] if uuid else [digest(raw)]
 
-    if (request.headers.get('X-Gitlab-Token', None) != bot.config.get('svc_token', None)):
-        return jsonify({'status': 'unauthorized'}), 401
+    # a tag announced by both a project hook (tag_push) and a system hook
+    # (repository_update) only matches on project, ref and revisions
+    change = data
+    if event == 'repository_update' and len(data.get('changes', [])) == 1:
+        change = data['changes'][0]
 
-    data = request.json
+    if event in ['tag_push', 'repository_update']\
+       and change.get('ref', '').startswith('refs/tags/'):
+        keys.append(digest(json.dumps(
+            ['tag', data['project']['path_with_namespace'],
+             change['ref'], change['before'], change['after']])))
+
+    return keys
+
+
+# drops an event from the inbox when it won't produce messages
+def forget(iid):
+    if bot.outbox:
+        bot.outbox.forget(iid)
+
+
+def deliver(event, data, iid=None):
+    try:
+        handle_event(event, data, iid)
+    except sqlite3.Error:
+        # the outbox is failing, the event stays in the inbox for the next
+        # start
+        raise
+    except Exception:
+        # not replayed, it would fail again
+        forget(iid)
+        raise
+
+
+def handle_event(event, data, iid):
+    chats = bot.route(event, data)
+    if not chats:
+        return forget(iid)
+
+    # buffered events stay in the inbox until their summary is posted
+    if digests.add(event, data, chats, iid):
+        return
+
+    size = budget(bot.render)
+
+    # TODO: move string to msg
+    def nofmt(data, size):
+        return 'New event "*{0}*" without formmater, write one for me!\n```\n{1}```\n'\
+               .format(event, truncate(headjson(data, size), size - 100))
+
+    with format_seconds.labels(event_label(event)).time():
+        m = fmt.get(event, nofmt)(data, size)
+
+    bot.broadcast(m, chats, [iid])
+
+
+if bot.config.get('async'):
+    work = AsyncWorkQueue(deliver, bot.loop,
+                          bot.config.get('queue', {}).get('workers', 4),
+                          bot.config.get('queue', {}).get('size', 1000))
+else:
+    work = WorkQueue(deliver,
+                     bot.config.get('queue', {}).get('workers', 4),
+                     bot.config.get('queue', {}).get('size', 1000))
+
+
+# queues the events accepted before the last stop that didn't reach the
+# outbox. runs once the port is bound, alongside the new ones
+def replay_inbox():
+    replay = bot.outbox.inbox()
+    if replay:
+        print('Replaying {0} events'.format(len(replay)))
+    skipped = [job for job in replay if not work.put(*job)]
+    if skipped:
+        print('Queue full, {0} events stay in the inbox until the next start'
+              .format(len(skipped)))
+
+
+def authorized(headers):
+    return headers.get('X-Gitlab-Token', None) == bot.config.get('svc_token', None)
+
+
+# set once shutdown starts, gitlab retries what's refused meanwhile
+closing = Event()
+
+max_size = bot.config.get('intake', {}).get('max_size', 10 * 1024 * 1024)
+app.config['MAX_CONTENT_LENGTH'] = max_size
+
+# the event kind as found in the raw body, the first matching field wins
+EVENT_FIELDS = [re.compile(rb'(?<!\\)"' + f + rb'"\s*:\s*"([^"\\]+)"')
+                for f in [b'object_kind', b'event_type', b'event_name']]
+
+
+def sniff_event(raw):
+    for field in EVENT_FIELDS:
+        m = field.search(raw)
+        if m:
+            return m.group(1).decode()
+
+
+# whether an event kind can produce a message, without parsing it
+def wanted(event):
+    if event not in fmt\
+       and not bot.config.get('intake', {}).get('unformatted', True):
+        return False
+
+    with bot.lock:
+        return bot.router.wants(event)
+
+
+# webhook intake shared by the flask and aiohttp servers. `read` returns the
+# raw request body, returns the response body and status code
+def webhook_response(headers, read):
+    start = time.perf_counter()
+    event, (body, code) = intake(headers, read)
+    label = event_label(event)
+    webhook_requests.labels(label, code).inc()
+    webhook_seconds.labels(label).observe(time.perf_counter() - start)
+    return body, code
+
+
+def intake(headers, read):
+    if not authorized(headers):
+        return None, ({'status': 'unauthorized'}, 401)
+
+    if closing.is_set():
+        return None, ({'status': 'shutting down'}, 503)
+
+    if int(headers.get('Content-Length') or 0) > max_size:
+        return None, ({'status': 'too large'}, 413)
+
+    raw = read()
+
+    # nobody gets this kind of event, don't bother parsing it
+    event = sniff_event(raw)
+    if event and not wanted(event):
+        return event, ({'status': 'ignored'}, 200)
+
+    try:
+        data = loads(raw)
+    except ValueError:
+        return event, ({'status': 'bad request'}, 400)
 
     # print('DEBUG =================\n' + dumpjson(data))
 
@@ -477,25 +896,192 @@ def webhook():
             event = data[e]
             break
 
-    # TODO: move string to msg
-    def nofmt():
-        return 'New event "*{0}*" without formmater, write one for me!\n```\n{1}```\n'\
-               .format(event, dumpjson(data))
+    keys = event_keys(event, data, headers, raw)
+    if not dedup.first(keys):
+        return event, ({'status': 'duplicate'}, 200)
+
+    # on disk before gitlab gets an answer, or gitlab must retry
+    try:
+        iid = bot.outbox.receive(event, raw) if bot.outbox else None
+    except sqlite3.Error:
+        dedup.forget(keys)
+        return event, ({'status': 'unavailable'}, 503)
+
+    # full queue, let gitlab retry the delivery later
+    if not work.put(event, data, iid):
+        dedup.forget(keys)
+        forget(iid)
+        return event, ({'status': 'busy'}, 503)
+
+    return event, ({'status': 'queued'}, 202)
+
+
+def status_response(headers):
+    if not authorized(headers):
+        return {'status': 'unauthorized'}, 401
+
+    return {'queue': work.status(),
+            'send': bot.scheduler.status(),
+            'outbox': bot.outbox.status() if bot.outbox else None,
+            'dedup': dedup.status()}, 200
+
+
+# telegram updates pushed to the bot's webhook
+def telegram_response(headers, load):
+    if not bot.push:
+        return {'status': 'polling'}, 404
+
+    if not hmac.compare_digest(
+            headers.get('X-Telegram-Bot-Api-Secret-Token', ''),
+            bot.webhook_secret):
+        return {'status': 'unauthorized'}, 401
+
+    bot.process_updates([load()])
+    return {'status': 'ok'}, 200
+
+
+@app.route("/", methods=['GET', 'POST'])
+def webhook():
+    body, code = webhook_response(request.headers, request.get_data)
+    return jsonify(body), code
+
+
+@app.route("/telegram", methods=['POST'])
+def telegram():
+    body, code = telegram_response(request.headers,
+                                   lambda: loads(request.get_data()))
+    return jsonify(body), code
+
+
+@app.route("/status", methods=['GET'])
+def status():
+    body, code = status_response(request.headers)
+    return jsonify(body), code
+
 
-    bot.broadcast(fmt.get(event, lambda _: nofmt())(data))
+metrics.gauge('queue_depth', 'Events waiting for a worker',
+              lambda: work.status()['depth'])
+metrics.gauge('send_pending', 'Messages waiting for the rate limiter',
+              lambda: bot.scheduler.status()['pending'])
+metrics.gauge('dedup_suppressed', 'Redelivered events dropped',
+              lambda: dedup.status()['suppressed'])
+metrics.gauge('chats', 'Known chats', lambda: len(bot.chats))
+metrics.gauge('ready_seconds', 'Time from start until commands are taken',
+              lambda: bot.ready or 0)
+metrics.gauge('telegram_updates_offset', 'Next update id to fetch',
+              lambda: bot.state.get('offset', 0))
 
-    return jsonify({'status': 'ok'})
 
+# prometheus text exposition
+@app.route("/metrics", methods=['GET'])
+def scrape():
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4')
 
-def exit():
-    bot.broadcast(msg('offline'))
+
+# the same routes on aiohttp, served from the bot's event loop. the
+# handlers wait on the outbox and the store, so they run on the executor
+async def serve_async(host, port):
+    from aiohttp import web
+
+    async def webhook(request):
+        raw = await request.read()
+        body, code = await bot.loop.run_in_executor(
+            None, webhook_response, request.headers, lambda: raw)
+        return web.json_response(body, status=code)
+
+    async def telegram(request):
+        raw = await request.read()
+        body, code = await bot.loop.run_in_executor(
+            None, telegram_response, request.headers, lambda: loads(raw))
+        return web.json_response(body, status=code)
+
+    async def status(request):
+        body, code = status_response(request.headers)
+        return web.json_response(body, status=code)
+
+    async def scrape(request):
+        return web.Response(body=metrics.render().encode(), headers={
+            'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    server = web.Application(client_max_size=max_size)
+    server.router.add_route('*', '/', webhook)
+    server.router.add_post('/telegram', telegram)
+    server.router.add_get('/status', status)
+    server.router.add_get('/metrics', scrape)
+
+    runner = web.AppRunner(server)
+    await runner.setup()
+    await web.TCPSite(runner, host, int(port)).start()
+    return runner
+
+
+# stops taking webhooks and commands, then gives the queued events and
+# messages until the deadline to go out. what's left stays in the outbox
+# for the next start. the state and offset are written once, at the end
+def shutdown(close_server):
+    deadline = time.monotonic() + bot.config.get('shutdown', {})\
+        .get('deadline', 10)
+
+    def left():
+        return max(0, deadline - time.monotonic())
+
+    # a second signal mustn't cut the drain short
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    print('Shutting down')
+    closing.set()
+    digests.close()
+    close_server()
+    bot.stop()
+
+    # events still queued are sent as they are, then what was buffered
+    work.stop(left())
+    digests.flush_all()
+    if not bot.clustered:
+        bot.broadcast(msg('offline'))
+
+    bot.scheduler.drain(left())
+    bot.scheduler.stop()
+    if bot.outbox:
+        bot.outbox.stop()
+
+    bot.close()
+    print('Stopped')
+
+
+# SIGTERM and SIGINT unwind the server loop into shutdown()
+def interrupt(signum, frame):
+    raise SystemExit(0)
 
 
 if __name__ == "__main__":
-    atexit.register(exit)
-    signal.signal(signal.SIGTERM, exit)
-    signal.signal(signal.SIGINT, exit)
+    signal.signal(signal.SIGTERM, interrupt)
+    signal.signal(signal.SIGINT, interrupt)
 
-    bot.run_threaded()
+    work.start()
     [host, port] = bot.config.get('listen', '0.0.0.0:10111').split(':')
-    app.run(host=host, port=port)
+
+    # listen before waiting on telegram, so gitlab deliveries made while
+    # restarting are accepted right away
+    if bot.config.get('async'):
+        runner = bot.call(serve_async(host, port)).result()
+        close_server = lambda: bot.call(runner.cleanup()).result(5)
+    else:
+        server = make_server(host, int(port), app, threaded=True)
+        close_server = server.server_close
+
+    print('Listening on {0}:{1} {2:.2f}s after start'
+          .format(host, port, time.monotonic() - bot.born))
+
+    if bot.outbox:
+        Thread(target=replay_inbox, daemon=True).start()
+    try:
+        if bot.config.get('async'):
+            bot.run()
+        else:
+            bot.run_threaded()
+            server.serve_forever()
+    finally:
+        shutdown(close_server)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+# formatter micro-benchmarks over the payloads in bench/fixtures, plus a
+# few extreme cases derived from them. runs offline, only formatters.py
+# is imported
+#
+#   python bench/run.py                 run and print the results
+#   python bench/run.py --save          also store them as the baseline
+#   python bench/run.py --compare       compare against the baseline
+
+import argparse
+import copy
+import glob
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+from formatters import eventFormatters as fmt  # noqa: E402
+
+
+def load_fixtures():
+    cases = {}
+    for path in sorted(glob.glob(os.path.join(here, 'fixtures', '*.json'))):
+        with open(path) as f:
+            cases[os.path.basename(path)[:-5]] = json.load(f)
+    return cases
+
+
+# the fixtures stretched to the sizes that hurt in production
+def extreme_cases(cases):
+    extremes = {}
+
+    push = copy.deepcopy(cases['push'])
+    push['commits'] = [dict(push['commits'][0],
+                            message='Commit {0}\n\n{1}'.format(i, 'body ' * 60))
+                       for i in range(20)]
+    push['total_commits_count'] = 20
+    extremes['push'] = ('push-20-commits', push)
+
+    update = copy.deepcopy(cases['repository_update'])
+    update['changes'] = [dict(c, ref='{0}_{1}'.format(c['ref'], i))
+                         for i in range(1000)
+                         for c in update['changes']]
+    extremes['repository_update'] = ('repository_update-5000-refs', update)
+
+    mr = copy.deepcopy(cases['merge_request'])
+    mr['object_attributes']['description'] = \
+        'A paragraph with some_markup *and* `code`.\n' * 2000
+    extremes['merge_request'] = ('merge_request-long-description', mr)
+
+    return [v for _, v in sorted(extremes.items())]
+
+
+def percentile(xs, p):
+    return xs[min(len(xs) - 1, int(len(xs) * p / 100))]
+
+
+def measure(event, data, seconds):
+    f = fmt[event]
+
+    # calibrate the number of calls to the time budget
+    t = time.perf_counter()
+    f(data)
+    once = max(time.perf_counter() - t, 1e-7)
+    calls = max(10, min(100000, int(seconds / once)))
+
+    samples = []
+    start = time.perf_counter()
+    for _ in range(calls):
+        t = time.perf_counter_ns()
+        f(data)
+        samples.append(time.perf_counter_ns() - t)
+    elapsed = time.perf_counter() - start
+
+    # blocks the call allocated that are still live when it returns, the
+    # message included. the snapshots' own blocks are left out
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    m = f(data)
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del m
+
+    own = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    stats = after.filter_traces(own).compare_to(before.filter_traces(own),
+                                                'filename')
+    samples.sort()
+    return {
+        'calls': calls,
+        'events_per_sec': round(calls / elapsed, 1),
+        'p50_us': round(percentile(samples, 50) / 1000, 2),
+        'p90_us': round(percentile(samples, 90) / 1000, 2),
+        'p99_us': round(percentile(samples, 99) / 1000, 2),
+        'alloc_blocks': sum(max(s.count_diff, 0) for s in stats),
+        'peak_kib': round(peak / 1024, 1)
+    }
+
+
+def run(seconds, only=None):
+    cases = load_fixtures()
+    runs = [(name, name, data) for name, data in cases.items()]
+    runs += [(name, name.split('-')[0], data)
+             for name, data in extreme_cases(cases)]
+
+    results = {}
+    for name, event, data in runs:
+        if only and only not in name:
+            continue
+        if event not in fmt:
+            print('no formatter for fixture {0}, skipped'.format(name))
+            continue
+        results[name] = measure(event, data, seconds)
+    return results
+
+
+def report(results, baseline=None, threshold=0.2):
+    cols = ['events_per_sec', 'p50_us', 'p90_us', 'p99_us',
+            'alloc_blocks', 'peak_kib']
+    print('{0:<34}'.format('case') + ''.join('{0:>17}'.format(c)
+                                             for c in cols))
+
+    regressions = []
+    for name, r in results.items():
+        line = '{0:<34}'.format(name) + ''.join('{0:>17}'.format(r[c])
+                                               for c in cols)
+
+        base = (baseline or {}).get(name)
+        if base:
+            ratio = r['p50_us'] / base['p50_us'] if base['p50_us'] else 1
+            line += '{0:>10.2f}x'.format(ratio)
+            if ratio > 1 + threshold:
+                regressions.append(name)
+                line += ' REGRESSION'
+
+        print(line)
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='formatter benchmarks')
+    parser.add_argument('--seconds', type=float, default=0.2,
+                        help='time budget per case')
+    parser.add_argument('--only', help='run cases containing this string')
+    parser.add_argument('--baseline', default=os.path.join(here,
+                                                           'baseline.json'))
+    parser.add_argument('--save', action='store_true',
+                        help='store the results as the new baseline')
+    parser.add_argument('--compare', action='store_true',
+                        help='compare the p50 latency against the baseline')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='slowdown ratio reported as a regression')
+    args = parser.parse_args()
+
+    results = run(args.seconds, args.only)
+
+    baseline = None
+    if args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    regressions = report(results, baseline, args.threshold)
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if regressions:
+        print('\n{0} regression(s): {1}'.format(len(regressions),
+                                                ', '.join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
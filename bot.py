@@ -1,14 +1,76 @@
 #!/usr/bin/env python
 
 import json
+import os
 import requests
+import socket
 import time
 
-from threading import Thread
+from requests.adapters import HTTPAdapter
+
+from concurrent.futures import Future
+from threading import Event, RLock, Thread, Timer, get_ident
+
+from metrics import SIZES, metrics
+from ratelimit import Scheduler
+from render import render
+from store import open_store
+from util import digest
+
+
+# future resolving to the first failed response of the group, or to the
+# last one when all succeed
+def gather(futures):
+    if len(futures) == 1:
+        return futures[0]
+
+    result = Future()
+    pending = [len(futures)]
+
+    def done(_):
+        pending[0] -= 1
+        if not pending[0]:
+            rs = [f.result() for f in futures]
+            result.set_result(next((r for r in rs if not r.get('ok')),
+                                   rs[-1]))
+
+    for f in futures:
+        f.add_done_callback(done)
+    return result
+
+
+api_seconds = metrics.histogram('telegram_api_seconds',
+                                'Telegram Bot API call latency', ('method',))
+api_calls = metrics.counter('telegram_api_calls_total',
+                            'Telegram Bot API calls by result code',
+                            ('method', 'code'))
+update_batch = metrics.histogram('telegram_updates_batch_size',
+                                 'Updates returned by each getUpdates call',
+                                 buckets=SIZES)
+update_offset = metrics.counter('telegram_updates_offset_advance_total',
+                                'Update ids consumed by getUpdates')
+save_seconds = metrics.histogram('state_save_seconds',
+                                 'Time spent writing the state store')
+
+# update kinds handled by msg_recv() and member_recv()
+UPDATES = [p + t for p in ['', 'edited_'] for t in ['message', 'channel_post']]
+MEMBERS = ['chat_member', 'my_chat_member']
+
+
+def observe_call(method, start, r):
+    api_seconds.labels(method).observe(time.perf_counter() - start)
+    api_calls.labels(method, 'ok' if r.get('ok')
+                     else r.get('error_code', 'network')).inc()
 
 
 class Bot:
+    # send_message() blocks, the scheduler runs it on its own threads
+    pooled_sends = True
+
     def __init__(self):
+        self.born = time.monotonic()
+        self.ready = None
+
         try:
             with open(self.configFile, "r") as cf:
                 self.config = json.load(cf)
@@ -19,24 +81,145 @@ class Bot:
         self.api = 'https://api.telegram.org/bot{0}/'\
                    .format(self.config.get('api_token'))
         self.defaults = self.config.get('defaults', {})
-        self.state = self.config.get('state', {})
-        self.config['state'] = self.state
-        self.me = self.botq('getMe')['result']
+        self.render = self.config.get('render', {})
+
+        try:
+            self.store = open_store(self.configFile, self.config)
+            self.state = self.store.load()
+        except Exception as e:
+            raise Exception("Couldn't open state store: {0}".format(e))
+
+        store = self.config.get('store', {})
+        self.save_window = store.get('window', 1)
+        self.compact_every = store.get('compact_every', 1000)
+        self.save_timer = None
+        self.saves = 0
+
+        # one pooled keep-alive session for every api call, sized to the
+        # number of threads that may be sending at the same time
+        http = self.config.get('http', {})
+        fanout = self.config.get('broadcast', {})
+        self.pool_size = http.get('pool_size', fanout.get('parallel', 8))
+        self.timeout = (http.get('connect_timeout', 5),
+                        http.get('read_timeout', 30))
+        self.session = requests.Session()
+        self.session.mount('https://',
+                           HTTPAdapter(pool_connections=1,
+                                       pool_maxsize=self.pool_size))
+
+        poll = self.config.get('poll', {})
+        self.poll_timeout = poll.get('timeout', 30)
+        self.refresh_interval = poll.get('refresh_interval', 1)
+
+        # telegram pushes updates to this url when set, instead of polling
+        webhook = self.config.get('webhook', {})
+        self.webhook_url = webhook.get('url')
+        self.webhook_secret = webhook.get(
+            'secret', digest(self.config.get('api_token', ''))[:64])
+        self.push = False
+
+        # replicas sharing the sqlite store: only the one holding the lease
+        # polls telegram, runs refresh() and writes the state. an empty
+        # "cluster" section is enough to turn it on
+        self.clustered = 'cluster' in self.config
+        if self.clustered and store.get('backend') == 'json':
+            raise Exception("Replicas need the sqlite state store")
+        # telegram would push commands to whichever replica the load
+        # balancer picks, not to the leader
+        if self.clustered and self.webhook_url:
+            raise Exception("Replicas must poll telegram, unset webhook.url")
+        cluster = self.config.get('cluster') or {}
+        self.replica = cluster.get('id', '{0}:{1}'.format(socket.gethostname(),
+                                                          os.getpid()))
+        self.lease_time = cluster.get('lease', 15)
+        self.sync_interval = cluster.get('sync', 5)
+        self.leader = not self.clustered
+
+        # updates and refresh run on different threads and share state
+        self.lock = RLock()
+        self.stopped = Event()
+
+        self.send_timeout = (self.timeout[0], fanout.get('timeout', 10))
+        self.scheduler = Scheduler(self.send_message,
+                                   self.config.get('ratelimit', {}),
+                                   fanout.get('parallel', 8),
+                                   fanout.get('retries', 1),
+                                   self.pooled_sends)
+        self.scheduler.start()
+
+        # replies to the batches processed since the last commit, sent once
+        # it succeeds
+        self.held = []
+        self.holder = None
+        self.uncommitted = False
+
+        # fetched again once running, startup doesn't wait on telegram
+        self.me = self.state.get('me')
         self.running = False
 
-    def botq(self, method, params=None):
+    def botq(self, method, params=None, timeout=None):
         url = self.api + method
         params = params if params else {}
-        return requests.post(url, params).json()
+        start = time.perf_counter()
+        try:
+            r = self.session.post(url, params,
+                                  timeout=timeout or self.timeout).json()
+        except (requests.RequestException, ValueError) as e:
+            print('{0} failed: {1}'.format(method, e))
+            r = {'ok': False, 'description': str(e)}
+
+        observe_call(method, start, r)
+        return r
+
+    def send_message(self, params):
+        return self.botq('sendMessage', params, timeout=self.send_timeout)
 
+    # writes within save_window seconds of each other are coalesced
     def save_config(self):
-        try:
-            with open(self.configFile, "w") as cf:
-                json.dump(self.config, cf, indent=2, sort_keys=False)
-                cf.write("\n")
-                cf.close()
-        except:
-            raise Exception("Couldn't write configuration")
+        with self.lock:
+            if not self.save_window:
+                return self.flush_config()
+
+            if not self.save_timer:
+                self.save_timer = Timer(self.save_window, self.flush_config)
+                self.save_timer.daemon = True
+                self.save_timer.start()
+
+    def flush_config(self):
+        with self.lock:
+            if self.save_timer:
+                self.save_timer.cancel()
+                self.save_timer = None
+
+            # the leader owns the shared state
+            if not self.leader:
+                return
+
+            try:
+                with save_seconds.time():
+                    self.dump_state()
+                    self.store.save(self.state)
+            except Exception as e:
+                raise Exception("Couldn't write state: {0}".format(e))
+
+            self.saves += 1
+            if self.saves % self.compact_every == 0:
+                self.store.compact()
+
+    # reads the state back from the store
+    def reload(self):
+        with self.lock:
+            self.state = self.store.load()
+            self.load_state()
+
+    def load_state(self):
+        ''' abstract'''
+        pass
+
+    # puts back into self.state what's kept outside of it
+    def dump_state(self):
+        ''' abstract'''
+        pass
 
     def refresh(self):
         ''' abstract'''
@@ -46,16 +229,116 @@ class Bot:
         ''' abstract'''
         pass
 
+    def member_recv(self, m):
+        ''' abstract'''
+        pass
+
+    # getUpdates parameters and request timeout. long poll: telegram holds
+    # the request until an update arrives
+    def poll_request(self):
+        params = {
+            'offset': self.state.get('offset', 0),
+            'timeout': self.poll_timeout,
+            'allowed_updates': json.dumps(UPDATES + MEMBERS)
+        }
+        return params, (self.timeout[0], self.timeout[1] + self.poll_timeout)
+
     def get_updates(self):
-        r = self.botq('getUpdates', {'offset': self.state.get('offset', 0)})
+        params, timeout = self.poll_request()
+        r = self.botq('getUpdates', params, timeout=timeout)
+
+        # stopped during the long poll: the next run gets these again
+        if not r.get('ok') or not self.running:
+            return False
+
+        self.process_updates(r['result'])
+        return True
+
+    # registers the webhook when an url is configured, telegram then pushes
+    # updates to process_updates() through the server. returns False when
+    # updates must be polled instead
+    def set_webhook(self):
+        if self.webhook_url:
+            r = self.botq('setWebhook', {
+                'url': self.webhook_url,
+                'secret_token': self.webhook_secret,
+                'allowed_updates': json.dumps(UPDATES + MEMBERS)
+            })
+            if r.get('ok'):
+                self.state['webhook'] = self.webhook_url
+                self.save_config()
+                return True
+
+            print("Couldn't set webhook, polling instead: {0}"
+                  .format(r.get('description', '')))
+
+        # getUpdates fails while a webhook from a previous run is set
+        if self.state.pop('webhook', None):
+            self.botq('deleteWebhook')
+            self.save_config()
+        return False
+
+    # a batch is applied and written with its offset in one commit, its
+    # replies only go out after that. a crash before the commit gets the
+    # whole batch again on top of the previous state, none of it twice
+    def process_updates(self, updates):
+        # the first poll has no previous offset to advance from
+        update_batch.observe(len(updates))
+        if updates and self.state.get('offset'):
+            update_offset.inc(max(0, updates[-1]['update_id'] + 1
+                                  - self.state.get('offset', 0)))
+        if not updates:
+            return
+
+        with self.lock:
+            self.holder = get_ident()
+            try:
+                for update in updates:
+                    # a failing command mustn't cost the others their
+                    # commit and replies
+                    try:
+                        self.process_update(update)
+                    except Exception as e:
+                        print("Couldn't handle update {0}: {1}"
+                              .format(update.get('update_id'), e))
+            finally:
+                self.holder = None
+            self.uncommitted = True
+
+        self.commit_updates()
+
+    # writes the state with the offset, then sends the replies held for it.
+    # when the write fails the replies keep waiting and the run loop tries
+    # again on its next pass
+    def commit_updates(self):
+        with self.lock:
+            try:
+                self.flush_config()
+            except Exception as e:
+                print("Couldn't commit updates, retrying: {0}".format(e))
+                return False
+            held, self.held = self.held, []
+            self.uncommitted = False
+
+        for to, msg, f in held:
+            self.send(to, msg).add_done_callback(
+                lambda r, f=f: f.set_result(r.result()))
+        return True
+
+    def process_update(self, update):
+        # telegram redelivers pushed updates it didn't get an answer for
+        if update['update_id'] < self.state.get('offset', 0):
+            return
+
+        self.state['offset'] = update['update_id'] + 1
 
-        for update in r['result']:
-            self.state['offset'] = update['update_id'] + 1
+        for u in UPDATES:
+            if u in update:
+                self.msg_recv(update[u])
 
-            for u in [p + t for p in ['', 'edited']
-                      for t in ['message', 'channel_post']]:
-                if u in update:
-                    self.msg_recv(update[u])
+        for u in MEMBERS:
+            if u in update:
+                self.member_recv(update[u])
 
     def get_chat(self, msg):
         c = msg.get('chat', msg)
@@ -65,35 +348,142 @@ class Bot:
             'name': c.get('username', c.get('name', c.get('title')))
         }
 
+    # None when the list couldn't be fetched
     def get_chat_admins(self, c):
         r = self.botq('getChatAdministrators', {'chat_id': c['id']})
-        return r['result']
+        return r.get('result')
 
+    # returns a future for the response. replies to a batch of updates wait
+    # for the batch to be committed
     def reply(self, to, msg):
         if type(to) not in [int, str]:
             to = self.get_chat(to)['id']
 
-        return self.botq('sendMessage',
-                         {
-                             'chat_id': to,
-                             'text': msg,
-                             'disable_web_page_preview': True,
-                             'parse_mode': 'Markdown'
-                         })
+        if self.holder == get_ident():
+            f = Future()
+            self.held.append((to, msg, f))
+            return f
+
+        return self.send(to, msg)
+
+    # queues the message on the scheduler, split in parts if it's too long
+    # for telegram
+    def send(self, to, msg):
+        return gather([self.scheduler.submit(to,
+                                             {
+                                                 'chat_id': to,
+                                                 'text': part,
+                                                 'disable_web_page_preview': True,
+                                                 'parse_mode': 'Markdown'
+                                             })
+                       for part in render(msg, self.render)])
+
+    # a new leader starts from the state its predecessor wrote, a replica
+    # that lost the lease goes back to following it
+    def lead(self, leader):
+        print('Replica {0} {1} the leader'
+              .format(self.replica, 'is now' if leader else 'is no longer'))
+        with self.lock:
+            self.leader = leader
+            self.reload()
+        self.push = leader and self.set_webhook()
+
+    # renews the lease every third of its duration, followers reload the
+    # state every sync_interval seconds
+    def run_lease(self):
+        synced = time.monotonic()
+        while True:
+            try:
+                held = self.store.lease(self.replica, self.lease_time)
+            except Exception as e:
+                print("Couldn't renew lease: {0}".format(e))
+                held = False
+
+            if held != self.leader:
+                self.lead(held)
+                synced = time.monotonic()
+
+            elif not held and time.monotonic() - synced >= self.sync_interval:
+                self.reload()
+                synced = time.monotonic()
+
+            if self.stopped.wait(self.lease_time / 3):
+                break
+
+    def run_refresh(self):
+        while not self.stopped.wait(self.refresh_interval):
+            with self.lock:
+                if self.leader:
+                    self.refresh()
+
+    # the bot's own user, kept in the state. a cached copy is refreshed in
+    # the background, without one this waits for telegram
+    def load_me(self):
+        if self.me:
+            Thread(target=self.fetch_me, daemon=True).start()
+            return
+
+        while self.running and not self.fetch_me():
+            self.stopped.wait(1)
+
+    def fetch_me(self):
+        r = self.botq('getMe')
+        if not r.get('ok'):
+            return False
+
+        with self.lock:
+            self.me = r['result']
+            if self.state.get('me') != self.me:
+                self.state['me'] = self.me
+                self.save_config()
+        return True
+
+    def start_updates(self):
+        self.load_me()
+
+        if self.clustered:
+            Thread(target=self.run_lease, daemon=True).start()
+        else:
+            self.push = self.set_webhook()
+
+        self.ready = time.monotonic() - self.born
+        print('Ready for commands {0:.2f}s after start'.format(self.ready))
 
     def run(self):
         self.running = True
+        self.stopped.clear()
+        Thread(target=self.run_refresh, daemon=True).start()
+        self.start_updates()
+
         while self.running:
-            self.get_updates()
-            self.refresh()
-            time.sleep(1)
+            # nothing new is taken before the last batch is written
+            if self.uncommitted and not self.commit_updates():
+                self.stopped.wait(1)
+
+            # updates are pushed, or polled by another replica
+            elif self.push or not self.leader:
+                self.stopped.wait(1)
 
+            # back off a bit when telegram is unreachable
+            elif not self.get_updates():
+                time.sleep(1)
+
+    # a long poll in flight isn't waited for, its updates are dropped
     def run_threaded(self):
-        t = Thread(target=self.run)
+        t = Thread(target=self.run, daemon=True)
         t.start()
 
     def stop(self):
         self.running = False
+        self.stopped.set()
+
+    # writes the state and offset once everything else has stopped, and
+    # lets another replica take over right away
+    def close(self):
+        self.flush_config()
+        if self.clustered and self.leader:
+            self.store.release(self.replica)
+            self.leader = False
 
 
 if __name__ == '__main__':
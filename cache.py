@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+import random
+import time
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+
+# mapping whose entries go stale after ttl seconds, randomly stretched or
+# shortened by up to `jitter` of the ttl so entries added together don't
+# all expire together. the oldest entries are evicted past maxsize
+class TTLCache:
+    def __init__(self, ttl, jitter=0, maxsize=None):
+        self.ttl = ttl
+        self.jitter = jitter
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    # returns (value, fresh), value is None when not cached at all
+    def peek(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None, False
+            expires, value = self.entries[key]
+            return value, time.monotonic() < expires
+
+    def get(self, key, default=None):
+        value, fresh = self.peek(key)
+        return value if fresh else default
+
+    def set(self, key, value):
+        self.add(key, value, replace=True)
+
+    # sets the key unless it holds a fresh value, True if it was set
+    def add(self, key, value, replace=False):
+        ttl = self.ttl * (1 + random.uniform(-self.jitter, self.jitter))
+        now = time.monotonic()
+
+        with self.lock:
+            if not replace and key in self.entries \
+                    and now < self.entries[key][0]:
+                return False
+
+            self.entries[key] = (now + ttl, value)
+            self.entries.move_to_end(key)
+            if self.maxsize and len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+        return True
+
+    def pop(self, key):
+        with self.lock:
+            return self.entries.pop(key, (None, None))[1]
+
+
+# chat administrator lists, fetched on a bounded background pool. reads
+# never block on the api: a missing or stale entry is returned as is and
+# a refresh is queued, on_update(chat id) is called when it lands
+class AdminCache:
+    def __init__(self, fetch, on_update, ttl=60, jitter=0.2, workers=4):
+        self.fetch = fetch
+        self.on_update = on_update
+        self.cache = TTLCache(ttl, jitter)
+        self.pool = ThreadPoolExecutor(workers)
+        self.pending = set()
+        self.lock = Lock()
+
+    def get(self, c):
+        admins, fresh = self.cache.peek(c['id'])
+        if not fresh:
+            self.refresh(c)
+        return admins
+
+    def refresh(self, c):
+        with self.lock:
+            if c['id'] in self.pending:
+                return
+            self.pending.add(c['id'])
+
+        self.pool.submit(self.load, dict(c))
+
+    # whether a fetch for the chat is queued or running
+    def loading(self, c):
+        with self.lock:
+            return c['id'] in self.pending
+
+    def load(self, c):
+        try:
+            admins = self.fetch(c)
+        finally:
+            with self.lock:
+                self.pending.discard(c['id'])
+
+        # keep serving the old list if the api call failed
+        if admins is not None:
+            self.cache.set(c['id'], admins)
+            self.on_update(c['id'])
+
+    def invalidate(self, cid):
+        self.cache.pop(cid)
+
+
+# remembers recently seen event keys to drop redeliveries, bounded in
+# both age and size
+class Dedup:
+    def __init__(self, ttl=3600, maxsize=10000):
+        self.seen = TTLCache(ttl, maxsize=maxsize)
+        self.suppressed = 0
+
+    # True unless any of the keys was seen within the ttl
+    def first(self, keys):
+        new = [self.seen.add(k, True) for k in keys]
+        if all(new):
+            return True
+
+        self.suppressed += 1
+        return False
+
+    def forget(self, keys):
+        for k in keys:
+            self.seen.pop(k)
+
+    def status(self):
+        return {'tracked': len(self.seen), 'suppressed': self.suppressed}
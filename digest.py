@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+from threading import Lock, Timer
+
+from formatters import eventFormatters, formatDigestMsg
+
+
+# buffers push-like events per project for a time window and emits a
+# single summary for all of them when the window closes
+class Digest:
+    kinds = ['push', 'tag_push', 'repository_update']
+
+    def __init__(self, emit, settings=None):
+        settings = settings or {}
+        self.emit = emit
+        self.window = settings.get('window', 0)
+        self.projects = settings.get('projects', {})
+        self.top = settings.get('top', 5)
+        self.buffers = {}
+        self.lock = Lock()
+        self.closed = False
+
+    def window_for(self, project):
+        return self.projects.get(project, self.window)
+
+    # True when the event was buffered and must not be delivered now
+    def add(self, event, data, chats, source=None):
+        if event not in self.kinds:
+            return False
+
+        project = data['project']['path_with_namespace']
+        window = self.window_for(project)
+        if not window:
+            return False
+
+        with self.lock:
+            if self.closed:
+                return False
+            if project not in self.buffers:
+                timer = Timer(window, self.flush, [project])
+                timer.daemon = True
+                self.buffers[project] = {'timer': timer, 'events': []}
+                timer.start()
+            self.buffers[project]['events'].append(
+                (event, data, set(chats), source))
+
+        return True
+
+    def flush(self, project):
+        with self.lock:
+            buf = self.buffers.pop(project, None)
+        if not buf:
+            return
+
+        buf['timer'].cancel()
+        events = buf['events']
+        # the events leave the inbox with the last message, a crash before
+        # that delivers them again
+        sources = [e[3] for e in events]
+
+        # each chat gets a summary of the events routed to it, chats that
+        # got the same ones share the message
+        groups = {}
+        for cid in sorted(set().union(*(e[2] for e in events))):
+            seen = tuple(i for i, e in enumerate(events) if cid in e[2])
+            groups.setdefault(seen, []).append(cid)
+
+        last = len(groups) - 1
+        for n, (seen, chats) in enumerate(groups.items()):
+            picked = [events[i][:2] for i in seen]
+
+            # nothing to coalesce, send the usual message
+            if len(picked) == 1:
+                event, data = picked[0]
+                m = eventFormatters[event](data)
+            else:
+                m = formatDigestMsg(project, picked, self.top)
+            self.emit(m, chats, sources if n == last else ())
+
+    # stops buffering, events are delivered right away from now on
+    def close(self):
+        with self.lock:
+            self.closed = True
+
+    def flush_all(self):
+        for project in list(self.buffers):
+            self.flush(project)
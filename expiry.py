@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+import heapq
+import itertools
+
+
+# priority queue of entries keyed on their refresh timestamp, which also
+# looks them up by key. rescheduled and cancelled entries are dropped
+# lazily when they reach the top
+class Expiry:
+    def __init__(self):
+        self.heap = []
+        self.entries = {}
+        self.seq = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def schedule(self, key, obj):
+        when = obj['refresh']
+        self.entries[key] = (when, obj)
+        heapq.heappush(self.heap, (when, next(self.seq), key))
+
+        # too many stale entries, rebuild from the live ones
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = [(w, next(self.seq), k)
+                         for k, (w, _) in self.entries.items()]
+            heapq.heapify(self.heap)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        return entry[1] if entry else None
+
+    def cancel(self, key):
+        self.entries.pop(key, None)
+
+    # pops the entries whose refresh is older than now
+    def due(self, now):
+        r = []
+        while self.heap and self.heap[0][0] < now:
+            when, _, key = heapq.heappop(self.heap)
+            entry = self.entries.get(key)
+            if entry and entry[0] == when:
+                del self.entries[key]
+                r.append((key, entry[1]))
+        return r
@@ -3,110 +3,215 @@
 import re
 
 
+REF_TYPE = re.compile(r'/([^/]+)/[^/]+$')
+REF_NAME = re.compile(r'/([^/]+)$')
+NAMESPACE = re.compile(r'^([^/]+)/.*$')
+BASENAME = re.compile(r'^.*/([^/]+)$')
+ACTION = re.compile(r'^.*_([^_]+)$')
+SSH_KEY_TYPE = re.compile(r'^ssh-([^ ]+) ')
+NO_ANCHOR = re.compile(r'^(.*)#[^#]+$')
+MARKDOWN = re.compile(r'([_*`\[])')
+
+
+# Telegram's Markdown can't escape inside an entity, so values placed
+# inside *bold* or [link text] are left alone. plain text gets its markup
+# characters escaped, and urls get their underscores escaped
+def esc(text):
+    return MARKDOWN.sub(r'\\\1', str(text))
+
+
+def esc_url(url):
+    return url.replace("_", "\\_")
+
+
+def link(text, url):
+    return '[{0}]({1})'.format(text, esc_url(url))
+
+
+def header(name):
+    return '*{0}*\n\n'.format(name)
+
+
+def ref_name(ref):
+    return REF_NAME.search(ref).group(1)
+
+
+def ref_type(ref):
+    return REF_TYPE.search(ref).group(1)
+
+
+def null_sha(sha):
+    return not int('0x' + sha, 0)
+
+
+# formatters take the payload and an optional budget in characters. the
+# ones rendering lists or long texts stop once it's spent, so a message
+# that is going to be cut anyway isn't built whole first
+
+# appends lazily rendered items while they fit in the budget, then a line
+# counting the ones left out
+def bounded(msg, items, count, budget, what):
+    used = sum(map(len, msg))
+    for i, item in enumerate(items):
+        if budget is not None and used + len(item) > budget:
+            msg.append('\n...and {0}more {1}\n'
+                       .format('' if count is None else str(count - i) + ' ',
+                               what))
+            break
+        msg.append(item)
+        used += len(item)
+    return msg
+
+
+# plain text cut to the budget left by the message built so far
+def clip(msg, text, budget):
+    if budget is None:
+        return text
+
+    room = max(0, budget - sum(map(len, msg)))
+    if len(text) <= room:
+        return text
+    return text[:room].rstrip('\\') + '...'
+
+
 # generic event called from webhooks set by admins (lacking info)
-def formatRepoUpdateMsg(data):
-    changes = []
-    for change in data['changes']:
+def formatRepoUpdateMsg(data, budget=None):
+    web_url = data['project']['web_url']
+
+    def change_line(change):
         if 'ref' in change:
-            refType = re.search(r'/([^/]+)/[^/]+$', change['ref']).group(1)
-            refName = re.search(r'/([^/]+)$', change['ref']).group(1)
+            refType = ref_type(change['ref'])
+            refName = ref_name(change['ref'])
 
             if refType == 'tags':
-                if not int('0x' + change['before'], 0):
-                    msg = 'tagged [{0}]({1}/-/commit/{0}) with tag *"{2}"*\n'\
-                          .format(change['after'],
-                                  data['project']['web_url'].replace("_", "\_"),
+                if null_sha(change['before']):
+                    msg = 'tagged {0} with tag *"{1}"*\n'\
+                          .format(link(change['after'], '{0}/-/commit/{1}'
+                                       .format(web_url, change['after'])),
                                   refName)
                 else:
-                    msg = 'removed tag *"{0}"* from [{1}]({2}/-/commit/{1})\n'\
+                    msg = 'removed tag *"{0}"* from {1}\n'\
                           .format(refName,
-                                  change['after'],
-                                  data['project']['web_url']).replace("_", "\_")
+                                  link(change['after'], '{0}/-/commit/{1}'
+                                       .format(web_url, change['after'])))
 
             elif refType == 'heads':
-                if not int('0x' + change['before'], 0):
-                    msg = 'created branch [{0}]({1}/-/tree/{0})\n'\
-                          .format(refName,
-                                  data['project']['web_url']).replace("_", "\_")
+                if null_sha(change['before']):
+                    msg = 'created branch {0}\n'\
+                          .format(link(refName, '{0}/-/tree/{1}'
+                                       .format(web_url, refName)))
 
-                elif not int('0x' + change['after'], 0):
+                elif null_sha(change['after']):
                     msg = 'removed branch *"{0}"*\n'.format(refName)
 
                 # ignore head changes non differentiable from normal commits
                 else:
-                    continue
+                    return None
 
             else:
-                msg = 'update with unknown ref type "{0}"\n'.format(refType)
+                msg = 'update with unknown ref type "{0}"\n'.format(esc(refType))
 
-            changes.append(msg)
+            return msg
 
-    msg = None
+    def lines():
+        for change in data['changes']:
+            line = change_line(change)
+            if line:
+                yield line
 
-    if len(changes):
-        msg = '*{0}*\n\n'.format(data['project']['path_with_namespace'])
+    # peek at the first two to tell single from multiple changes
+    changes = lines()
+    first = [line for _, line in zip(range(2), changes)]
 
-        msg += '*{0}* {1}'\
-               .format(data['user_name'],
-                       'issued multiple changes\n\n' if len(changes) > 1 else '')
+    if not first:
+        return None
 
-        msg += '\n'.join(changes)
+    msg = [header(data['project']['path_with_namespace']),
+           '*{0}* '.format(data['user_name']),
+           'issued multiple changes\n\n' if len(first) > 1 else '']
 
-    return msg
+    def joined():
+        for i, line in enumerate(first):
+            yield ('\n' if i else '') + line
+        for line in changes:
+            yield '\n' + line
+
+    return ''.join(bounded(msg, joined(), None, budget, 'changes'))
 
 
-def formatPushMsg(data):
-    msg = '*{0}*\n\n'.format(data['project']['path_with_namespace'])
+def formatPushMsg(data, budget=None):
+    msg = [header(data['project']['path_with_namespace'])]
 
     # assume 0 commits push is a reset
     if data['total_commits_count'] == 0:
-        msg += '*{0}* performed a reset at branch *{2}*\n'\
-                .format(data['user_name'],
-                        re.search(r'/([^/]+)$', data['ref']).group(1))
+        msg.append('*{0}* performed a reset at branch *{1}*\n'
+                   .format(data['user_name'],
+                           ref_name(data['ref'])))
     else:
-        msg += '*{0}* pushed *{1}* new commits to branch *{2}*\n'\
-                .format(data['user_name'],
-                        data['total_commits_count'],
-                        re.search(r'/([^/]+)$', data['ref']).group(1))
-
-    for commit in data['commits']:
-        part = commit['message'].rstrip().partition('\n')
-        msg += '\n[{0}]({1})\n{2}\n'\
-               .format(part[0],
-                       commit['url'].replace("_", "\_"),
-                       part[2])
+        msg.append('*{0}* pushed *{1}* new commits to branch *{2}*\n'
+                   .format(data['user_name'],
+                           data['total_commits_count'],
+                           ref_name(data['ref'])))
 
-    return msg
+    def commits():
+        for commit in data['commits']:
+            part = commit['message'].rstrip().partition('\n')
+            yield '\n{0}\n{1}\n'.format(link(part[0], commit['url']),
+                                        esc(part[2]))
+
+    return ''.join(bounded(msg, commits(), len(data['commits']), budget,
+                           'commits'))
 
 
 # note that if you enable tag push notifications both side wide (handled by
 # formatRepoUpdateMsg) and per repo (handled here), you'll get notifications
 # twice for this event until you disable one of the webhooks
-def formatTagPushMsg(data):
-    msg = '*{0}*\n\n'.format(data['project']['path_with_namespace'])
+def formatTagPushMsg(data, budget=None):
+    msg = [header(data['project']['path_with_namespace'])]
 
-    refName = re.search(r'/([^/]+)$', data['ref']).group(1)
+    refName = ref_name(data['ref'])
 
-    if not int('0x' + data['before'], 0):
-        msg += '*{0}* tagged [{1}]({2}) with tag *"{3}"*\n\n'\
-               .format(data['user_name'],
-                       data['checkout_sha'],
-                       data['commits'][0]['url'].replace("_", "\_"),
-                       refName)
+    if null_sha(data['before']):
+        msg.append('*{0}* tagged {1} with tag *"{2}"*\n\n'
+                   .format(data['user_name'],
+                           link(data['checkout_sha'],
+                                data['commits'][0]['url']),
+                           refName))
 
     else:
-        msg += '*{0}* removed tag *"{1}"* from [{2}]({3}/-/commit/{2})\n'\
-               .format(data['user_name'],
-                       refName,
-                       data['before'],
-                       data['project']['web_url'].replace("_", "\_"))
+        msg.append('*{0}* removed tag *"{1}"* from {2}\n'
+                   .format(data['user_name'],
+                           refName,
+                           link(data['before'], '{0}/-/commit/{1}'
+                                .format(data['project']['web_url'],
+                                        data['before']))))
+
+    return ''.join(msg)
+
+
+# bullets for the fields changed by an update action
+def changes_list(data):
+    return ''.join(line for key, line in [
+        ('assignees', '• Assignees were changed\n'),
+        ('labels', '• Labels were changed\n'),
+        ('discussion_locked', '• The discussion was locked \n')
+    ] if key in data['changes'])
 
-    return msg
+
+def labels_list(data, default):
+    def names(key, field):
+        if key not in data:
+            return default
+        return [x[field] for x in data[key]]
+
+    return '*labels:* {0}\n*asignees:* {1}\n'\
+           .format(esc(', '.join(names('labels', 'title'))),
+                   esc(', '.join(names('assignees', 'name'))))
 
 
 # TODO: can be made more informative
-def formatMergeRequestMsg(data):
-    msg = '*{0}*\n\n'.format(data['project']['path_with_namespace'])
+def formatMergeRequestMsg(data, budget=None):
+    msg = [header(data['project']['path_with_namespace'])]
 
     attrs = data['object_attributes']
     action = attrs.get('action', 'open')
@@ -116,157 +221,111 @@ def formatMergeRequestMsg(data):
     else:
         source_branch = attrs['target']['path_with_namespace']
 
+    verb = {
+        'reopen': 'reopened',
+        'update': 'updated',
+        'close': 'closed'
+    }.get(action)
+
     if action == 'open':
-        msg += '*{0}* requested to merge from *{1}* into *{2}*\n'\
-               .format(data['user']['name'],
-                       source_branch,
-                       attrs['target_branch'])
-
-    elif action == 'reopen':
-        msg += '*{0}* reopened a merge request *{1}* from *{2}* into *{3}*\n'\
-               .format(data['user']['name'],
-                       attrs['id'],
-                       source_branch,
-                       attrs['target_branch'])
-
-    elif action == 'update':
-        msg += '*{0}* updated a merge request *{1}* from *{2}* into *{3}*\n'\
-               .format(data['user']['name'],
-                       attrs['id'],
-                       source_branch,
-                       attrs['target_branch'])
-
-        if 'assignees' in data['changes']:
-            msg += '• Assignees were changed\n'
-
-        if 'labels' in data['changes']:
-            msg += '• Labels were changed\n'
-
-        if 'discussion_locked' in data['changes']:
-            msg += '• The discussion was locked \n'
-
-    elif action == 'close':
-        msg += '*{0}* closed a merge request *{1}* from *{2}* into *{3}*\n'\
-               .format(data['user']['name'],
-                       attrs['id'],
-                       source_branch,
-                       attrs['target_branch'])
-
-    msg += '\n[{0}]({1})\n{2}\n'\
-           .format(attrs['title'],
-                   attrs['url'].replace("_", "\_"),
-                   attrs['description'])
+        msg.append('*{0}* requested to merge from *{1}* into *{2}*\n'
+                   .format(data['user']['name'],
+                           source_branch,
+                           attrs['target_branch']))
+
+    elif verb:
+        msg.append('*{0}* {1} a merge request *{2}* from *{3}* into *{4}*\n'
+                   .format(data['user']['name'],
+                           verb,
+                           attrs['id'],
+                           source_branch,
+                           attrs['target_branch']))
+
+    if action == 'update':
+        msg.append(changes_list(data))
+
+    msg.append('\n{0}\n{1}\n'.format(link(attrs['title'], attrs['url']),
+                                     clip(msg, esc(attrs['description']),
+                                          budget)))
 
     if action != 'close':
-        msg += '*labels:* ' + ", ".join([label['title'] for label in
-                                         data.get('labels', ['none'])]) + '\n'
-        msg += '*asignees:* ' + ", ".join([asignee['name'] for asignee in
-                                           data.get('assignees', ['none'])]) + '\n'
+        msg.append(labels_list(data, ['none']))
 
-    return msg
+    return ''.join(msg)
 
 
 # TODO: can be made more informative
-def formatIssueMsg(data):
-    msg = '*{0}*\n\n'.format(data['project']['path_with_namespace'])
+def formatIssueMsg(data, budget=None):
+    msg = [header(data['project']['path_with_namespace'])]
 
     attrs = data['object_attributes']
     action = attrs.get('action', 'open')
 
-    if action == 'open':
-        msg += '*{0}* opened issue *{1}*\n'.format(data['user']['name'], attrs['id'])
+    verb = {
+        'open': 'opened',
+        'reopen': 'reopened',
+        'update': 'updated',
+        'close': 'closed'
+    }.get(action)
 
-    elif action == 'reopen':
-        msg += '*{0}* reopened issue *{1}*\n'.format(data['user']['name'], attrs['id'])
+    if verb:
+        msg.append('*{0}* {1} issue *{2}*\n'
+                   .format(data['user']['name'], verb, attrs['id']))
 
-    elif action == 'update':
-        msg += '*{0}* updated issue *{1}*\n'.format(data['user']['name'], attrs['id'])
-        if 'assignees' in data['changes']:
-            msg += '• Assignees were changed\n'
+    if action == 'update':
+        msg.append(changes_list(data))
 
-        if 'labels' in data['changes']:
-            msg += '• Labels were changed\n'
-
-        if 'discussion_locked' in data['changes']:
-            msg += '• The discussion was locked \n'
-
-    elif action == 'close':
-        msg += '*{0}* closed issue *{1}*\n'\
-               .format(data['user']['name'],
-                       attrs['id'])
-
-    msg += '\n[{0}]({1})\n{2}\n\n'\
-           .format(attrs['title'],
-                   attrs['url'].replace("_", "\_"),
-                   attrs['description'])
+    msg.append('\n{0}\n{1}\n\n'.format(link(attrs['title'], attrs['url']),
+                                       clip(msg, esc(attrs['description']),
+                                            budget)))
 
     if action != 'close':
-        msg += '*labels:* ' + ", ".join([label['title'] for label in data.get('labels', [])]) + '\n'
-        msg += '*asignees:* ' + ", ".join([asignee['name'] for asignee in data.get('assignees', [])]) + '\n'
+        msg.append(labels_list(data, []))
 
-    return msg
+    return ''.join(msg)
 
 
-def formatNoteMsg(data):
-    msg = '*{0}*\n\n'.format(data['project']['path_with_namespace'])
+def formatNoteMsg(data, budget=None):
+    msg = [header(data['project']['path_with_namespace'])]
 
     attrs = data['object_attributes']
     nType = attrs['noteable_type']
 
-    if nType == 'Commit':
-        msg += '{0} [commented]({1}) on commit [{2}]({3})\n\n{4}'\
-               .format(data['user']['name'],
-                       attrs['url'].replace("_", "\_"),
-                       data['commit']['id'],
-                       data['commit']['url'].replace("_", "\_"),
-                       attrs['note'])
-
-    elif nType == 'MergeRequest':
-        msg += '{0} [commented]({1}) on Merge Request [{2}]({3})\n\n{4}'\
-               .format(data['user']['name'],
-                       attrs['url'].replace("_", "\_"),
-                       data['merge_request']['id'],
-                       data['merge_request']['url'].replace("_", "\_"),
-                       attrs['note'])
-
-    elif nType == 'Issue':
-        msg += '{0} [commented]({1}) on issue [{2}]({3})\n\n{4}'\
-               .format(data['user']['name'],
-                       attrs['url'].replace("_", "\_"),
-                       data['issue']['iid'],
-                       data['issue']['url'].replace("_", "\_"),
-                       attrs['note'])
-
-    elif nType == 'Snippet':
-        msg += '{0} [commented]({1}) on code snippet [{2}]({3})\n\n{4}'\
-               .format(data['user']['name'],
-                       attrs['url'].replace("_", "\_"),
-                       data['snippet']['id'],
-                       re.search(r'^(.*)#[^#]+$', attrs['url']).group(1).replace("_", "\_"),
-                       attrs['note'])
-
-    return msg
-
-
-def formatWikiMsg(data):
-    msg = '*{0}*\n\n'.format(data['project']['path_with_namespace'])
-
+    target = {
+        'Commit': lambda: ('commit', data['commit']['id'],
+                           data['commit']['url']),
+        'MergeRequest': lambda: ('Merge Request', data['merge_request']['id'],
+                                 data['merge_request']['url']),
+        'Issue': lambda: ('issue', data['issue']['iid'],
+                          data['issue']['url']),
+        'Snippet': lambda: ('code snippet', data['snippet']['id'],
+                            NO_ANCHOR.search(attrs['url']).group(1))
+    }.get(nType)
+
+    if target:
+        name, id_, url = target()
+        msg.append('{0} {1} on {2} {3}\n\n{4}'
+                   .format(esc(data['user']['name']),
+                           link('commented', attrs['url']),
+                           name,
+                           link(id_, url),
+                           clip(msg, esc(attrs['note']), budget)))
+
+    return ''.join(msg)
+
+
+def formatWikiMsg(data, budget=None):
     attrs = data['object_attributes']
     action = attrs.get('action', 'create')
 
-    msg += '*{0}* {1}d a Wiki entry\n\n'\
-           .format(data['user']['name'],
-                   action)
-
-    msg += '{0}[{1}]({2})'\
-           .format('(was) ' if action == 'delete' else '',
-                   attrs['title'],
-                   attrs['url'].replace("_", "\_"))
-
-    return msg
+    return ''.join([header(data['project']['path_with_namespace']),
+                    '*{0}* {1}d a Wiki entry\n\n'
+                    .format(data['user']['name'], action),
+                    '(was) ' if action == 'delete' else '',
+                    link(attrs['title'], attrs['url'])])
 
 
-def formatGroupMsg(data):
+def formatGroupMsg(data, budget=None):
     action = data['event_name']
 
     if action == 'group_create':
@@ -281,12 +340,12 @@ def formatGroupMsg(data):
     return msg
 
 
-def formatUserMsg(data):
+def formatUserMsg(data, budget=None):
     action = data['event_name']
 
     if action == 'user_create':
         msg = 'User *{0}* has been created\n\nFull name: {1}\nEmail: {2}'\
-               .format(data['username'], data['name'], data['email'])
+               .format(data['username'], esc(data['name']), esc(data['email']))
 
     elif action == 'user_rename':
         msg = 'User *{0}* has been renamed to *{1}*'.format(data['old_username'], data['username'])
@@ -298,33 +357,33 @@ def formatUserMsg(data):
         msg = 'User *{0}* has been added to group *{1}* with {2} access'\
               .format(data['user_name'],
                       data['group_path'],
-                      data['group_access'])
+                      esc(data['group_access']))
 
     elif action == 'user_remove_from_group':
         msg = 'User *{0}* has been removed from group *{1}* - access was {2}'\
               .format(data['user_name'],
                       data['group_path'],
-                      data['group_access'])
+                      esc(data['group_access']))
 
     elif action == 'user_update_for_group':
         msg = 'User *{0}* has been updated for group *{1}* - access is {2}'\
               .format(data['user_name'],
                       data['group_path'],
-                      data['group_access'])
+                      esc(data['group_access']))
 
     else:
-        msg = action
+        msg = esc(action)
 
     return msg
 
 
-def formatKeyMsg(data):
+def formatKeyMsg(data, budget=None):
     action = data['event_name']
 
     if action == 'key_create':
         msg = '*{0}* created an SSH key with type {1}'\
               .format(data['username'],
-                      re.search(r'^ssh-([^ ]+) ', data['key']).group(1))
+                      esc(SSH_KEY_TYPE.search(data['key']).group(1)))
 
     if action == 'key_destroy':
         msg = '*{0}* removed an SSH key' .format(data['username'])
@@ -332,43 +391,91 @@ def formatKeyMsg(data):
     return msg
 
 
-def formatProjectMsg(data):
-    msg = '*{0}*\n\n'.format(re.search(r'^([^/]+)/.*$', data['path_with_namespace']).group(1))
+def formatProjectMsg(data, budget=None):
+    msg = [header(NAMESPACE.search(data['path_with_namespace']).group(1))]
 
     action = data['event_name']
 
     if action in ['project_create', 'project_update']:
-        msg += 'Project *{0}* has been {1}d\n\npath: {2}\nvisibility: {3}\nowners: {4}'\
-               .format(data['name'],
-                       re.search(r'^.*_([^_]+)$', action).group(1),
-                       data['path_with_namespace'],
-                       data['project_visibility'],
-                       ", ".join([owner['name'] for owner in data.get('owners', [])]))
-
-        for owner in data.get('owners', []):
-            msg += '{0}{1}\n'\
-                   .format(owner['name'],
-                           (' ' + owner['email']) if owner['email'] else '')
+        owners = data.get('owners', [])
+
+        msg.append('Project *{0}* has been {1}d\n\npath: {2}\nvisibility: {3}\nowners: {4}'
+                   .format(data['name'],
+                           ACTION.search(action).group(1),
+                           esc(data['path_with_namespace']),
+                           esc(data['project_visibility']),
+                           esc(", ".join([owner['name'] for owner in owners]))))
+
+        msg.extend('{0}{1}\n'
+                   .format(esc(owner['name']),
+                           (' ' + esc(owner['email'])) if owner['email'] else '')
+                   for owner in owners)
 
     if action == 'project_rename':
-        msg += 'Project *{0}* path *{1}* has been renamed to *{2}*\n'\
-               .format(data['name'],
-                       re.search(r'^.*/([^/]+)$', data['old_path_with_namespace']).group(1),
-                       data['path'])
+        msg.append('Project *{0}* path *{1}* has been renamed to *{2}*\n'
+                   .format(data['name'],
+                           BASENAME.search(data['old_path_with_namespace']).group(1),
+                           data['path']))
 
     if action == 'project_transfer':
-        msg += 'Project *{0}* has been transferred from *{1}*\n\nold path: {2}\nnew path: {3}'\
-               .format(data['name'],
-                       re.search(r'^([^/]+)/.*$', data['old_path_with_namespace']).group(1),
-                       data['old_path_with_namespace'],
-                       data['path_with_namespace'])
+        msg.append('Project *{0}* has been transferred from *{1}*\n\nold path: {2}\nnew path: {3}'
+                   .format(data['name'],
+                           NAMESPACE.search(data['old_path_with_namespace']).group(1),
+                           esc(data['old_path_with_namespace']),
+                           esc(data['path_with_namespace'])))
 
     if action == 'project_destroy':
-        msg += 'Project *{0}* has been removed\n\npath was: {1}\n'\
-               .format(data['name'],
-                       data['path_with_namespace'])
+        msg.append('Project *{0}* has been removed\n\npath was: {1}\n'
+                   .format(data['name'],
+                           esc(data['path_with_namespace'])))
 
-    return msg
+    return ''.join(msg)
+
+
+# summary of several push, tag_push and repository_update events buffered
+# for the same project, see digest.py
+def formatDigestMsg(project, events, top=5):
+    branches, tags, authors, commits = [], [], [], []
+    count = 0
+
+    def add(xs, x):
+        if x not in xs:
+            xs.append(x)
+
+    for event, data in events:
+        add(authors, data['user_name'])
+
+        refs = [data['ref']] if event in ['push', 'tag_push']\
+            else [c['ref'] for c in data['changes'] if 'ref' in c]
+
+        for ref in refs:
+            add(tags if ref_type(ref) == 'tags' else branches, ref_name(ref))
+
+        if event == 'push':
+            count += data['total_commits_count']
+            commits.extend(data['commits'])
+
+    msg = [header(project),
+           '*{0}* updates with *{1}* new commits by {2}\n'
+           .format(len(events),
+                   count,
+                   ', '.join(['*{0}*'.format(a) for a in authors]))]
+
+    if branches:
+        msg.append('branches: {0}\n'.format(esc(', '.join(branches))))
+
+    if tags:
+        msg.append('tags: {0}\n'.format(esc(', '.join(tags))))
+
+    msg.extend('\n' + link(commit['message'].strip().partition('\n')[0],
+                           commit['url'])
+               for commit in commits[:top])
+
+    if len(commits) > top:
+        msg.append('\n\n...and {0} more'.format(len(commits) - top))
+
+    msg.append('\n')
+    return ''.join(msg)
 
 
 eventFormatters = {
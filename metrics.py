@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+import time
+
+from bisect import bisect_left
+
+
+# counters and histograms exported in the prometheus text format.
+# updates are plain adds on preallocated slots, without locks: under the
+# GIL a racing update can at worst be lost, which is fine for monitoring.
+# each label combination gets its slots on first use and keeps them
+
+LATENCY = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+SIZES = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def label_text(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(n, str(v).replace('"', '\\"'))
+                          for n, v in zip(names, values)) + '}'
+
+
+class CounterChild:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, v):
+        self.counts[bisect_left(self.buckets, v)] += 1
+        self.sum += v
+        self.count += 1
+
+    # times the enclosed block
+    def time(self):
+        return Timer(self)
+
+
+class Timer:
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *_):
+        self.child.observe(time.perf_counter() - self.start)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.names = labels
+        self.children = {}
+        if not labels:
+            self.children[()] = self.child()
+
+    def labels(self, *values):
+        c = self.children.get(values)
+        if c is None:
+            c = self.children.setdefault(values, self.child())
+        return c
+
+    def lines(self):
+        yield '# HELP {0} {1}'.format(self.name, self.help)
+        yield '# TYPE {0} {1}'.format(self.name, self.kind)
+        for values, c in list(self.children.items()):
+            yield from self.samples(label_text(self.names, values), values, c)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def child(self):
+        return CounterChild()
+
+    def inc(self, n=1):
+        self.children[()].inc(n)
+
+    def samples(self, labels, values, c):
+        yield '{0}{1} {2}'.format(self.name, labels, c.value)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY):
+        self.buckets = buckets
+        super(Histogram, self).__init__(name, help, labels)
+
+    def child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, v):
+        self.children[()].observe(v)
+
+    def time(self):
+        return self.children[()].time()
+
+    def samples(self, labels, values, c):
+        total = 0
+        for le, n in zip(list(self.buckets) + ['+Inf'], c.counts):
+            total += n
+            yield '{0}_bucket{1} {2}'.format(
+                self.name,
+                label_text(self.names + ('le',), values + (le,)),
+                total)
+        yield '{0}_sum{1} {2}'.format(self.name, labels, c.sum)
+        yield '{0}_count{1} {2}'.format(self.name, labels, c.count)
+
+
+# value read from a callback at scrape time
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn):
+        self.fn = fn
+        super(Gauge, self).__init__(name, help)
+
+    def child(self):
+        return None
+
+    def samples(self, labels, values, c):
+        yield '{0} {1}'.format(self.name, self.fn())
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, metric):
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, fn):
+        return self.add(Gauge(name, help, fn))
+
+    def render(self):
+        return '\n'.join(line for m in list(self.metrics.values())
+                         for line in m.lines()) + '\n'
+
+
+metrics = Registry()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+import json
+import sqlite3
+import time
+
+from itertools import count
+from threading import Condition, Event, Lock, Thread
+
+
+# on-disk queues for events and messages, so nothing accepted is lost on a
+# restart or a telegram outage. an event is written to the inbox before
+# gitlab gets its answer, and traded for its messages in the outbox once
+# formatted. messages are retried with exponential backoff and end up in
+# the dead letters after `attempts` failures. writes from every thread are
+# committed together by one writer thread
+class Outbox:
+    def __init__(self, path, send, attempts=5, backoff=2, backoff_max=600):
+        self.send = send
+        self.attempts = attempts
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS inbox ('
+                        'id INTEGER PRIMARY KEY, event TEXT, data TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS outbox ('
+                        'id INTEGER PRIMARY KEY, chat INTEGER, text TEXT, '
+                        'attempts INTEGER, next REAL, error TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS dead ('
+                        'id INTEGER PRIMARY KEY, chat INTEGER, text TEXT, '
+                        'attempts INTEGER, error TEXT)')
+        self.db.commit()
+        self.lock = Lock()
+
+        last = max(self.db.execute('SELECT MAX(id) FROM {0}'.format(t))
+                   .fetchone()[0] or 0 for t in ['inbox', 'outbox', 'dead'])
+        # rows from before this start have lower ids
+        self.first = last + 1
+        self.ids = count(self.first)
+
+        self.cond = Condition()
+        self.pending = []
+        self.inflight = set()
+        self.stopped = Event()
+        self.threads = []
+        self.stats = {'commits': 0, 'writes': 0, 'retried': 0, 'dead': 0}
+
+    # queues statements for the writer, waiting for their commit if asked,
+    # or calling then() once it's done either way. once stopped they're
+    # committed right away. a failed commit raises its sqlite3.Error to the
+    # callers that wait
+    def write(self, ops, wait=True, then=None):
+        done = Event()
+        failed = []
+        with self.cond:
+            inline = not self.threads or self.stopped.is_set()
+            if not inline:
+                self.pending.append((ops, done, failed, then))
+                self.cond.notify()
+
+        if inline:
+            self.commit([(ops, done, failed, then)])
+        elif wait:
+            done.wait()
+
+        if failed and wait:
+            raise failed[0]
+
+    def commit(self, batch):
+        try:
+            with self.lock, self.db:
+                for ops, _, _, _ in batch:
+                    for op in ops:
+                        self.db.execute(*op)
+            self.stats['commits'] += 1
+            self.stats['writes'] += len(batch)
+        except sqlite3.Error as e:
+            print('Outbox write failed: {0}'.format(e))
+            for _, _, failed, _ in batch:
+                failed.append(e)
+
+        for _, done, _, then in batch:
+            done.set()
+            if then:
+                then()
+
+    # everything queued while the last batch was committing goes in the next
+    def run_writer(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.stopped.is_set():
+                    self.cond.wait()
+                if not self.pending:
+                    break
+                batch, self.pending = self.pending, []
+
+            self.commit(batch)
+
+    def query(self, sql, args=()):
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    # stores an event's json body before it's acknowledged, returns its id
+    def receive(self, event, body):
+        iid = next(self.ids)
+        self.write([('INSERT INTO inbox VALUES (?, ?, ?)',
+                     (iid, event, body))])
+        return iid
+
+    def forget(self, iid):
+        if iid is not None:
+            self.write([('DELETE FROM inbox WHERE id = ?', (iid,))], False)
+
+    # events accepted but not formatted before the last stop
+    # the events left over from before this start
+    def inbox(self):
+        return [(event, json.loads(data), iid) for iid, event, data
+                in self.query('SELECT id, event, data FROM inbox '
+                              'WHERE id < ? ORDER BY id', (self.first,))]
+
+    # stores the messages of one or more events, dropping those from the
+    # inbox in the same commit, and sends them. returns the futures of the
+    # first attempt
+    def post(self, messages, sources=()):
+        rows = [(next(self.ids), chat, text) for chat, text in messages]
+        ops = [('INSERT INTO outbox VALUES (?, ?, ?, 0, 0, NULL)', r)
+               for r in rows]
+        ops += [('DELETE FROM inbox WHERE id = ?', (iid,))
+                for iid in sources if iid is not None]
+
+        # the rows are due as soon as they're committed, keep the retries
+        # away from them until they're sent below
+        with self.cond:
+            self.inflight.update(oid for oid, _, _ in rows)
+        try:
+            self.write(ops)
+        except sqlite3.Error:
+            with self.cond:
+                self.inflight.difference_update(oid for oid, _, _ in rows)
+            raise
+
+        return [self.submit(oid, chat, text, 0) for oid, chat, text in rows]
+
+    def submit(self, oid, chat, text, attempts):
+        with self.cond:
+            self.inflight.add(oid)
+        f = self.send(chat, text)
+        f.add_done_callback(
+            lambda f: self.sent(oid, chat, text, attempts + 1, f.result()))
+        return f
+
+    # the row is only released to the retries once the update is committed.
+    # nothing waits for that here, this may run on the bot's event loop
+    def sent(self, oid, chat, text, attempts, r):
+        code = r.get('error_code', 0)
+        if r.get('ok'):
+            ops = [('DELETE FROM outbox WHERE id = ?', (oid,))]
+
+        # 4xx errors other than throttling (blocked bot, missing chat)
+        # won't go away
+        elif attempts >= self.attempts\
+                or (400 <= code < 500 and code != 429):
+            self.stats['dead'] += 1
+            ops = [('INSERT INTO dead VALUES (?, ?, ?, ?, ?)',
+                    (oid, chat, text, attempts, r.get('description'))),
+                   ('DELETE FROM outbox WHERE id = ?', (oid,))]
+
+        else:
+            # never sooner than telegram asked for
+            delay = max(min(self.backoff_max, self.backoff ** attempts),
+                        r.get('parameters', {}).get('retry_after', 0))
+            ops = [('UPDATE outbox SET attempts = ?, next = ?, error = ? '
+                    'WHERE id = ?',
+                    (attempts, time.time() + delay, r.get('description'),
+                     oid))]
+
+        # a failed update leaves the row as it was for the retries
+        def release():
+            with self.cond:
+                self.inflight.discard(oid)
+
+        self.write(ops, False, release)
+
+    # sends the messages whose backoff is over, including everything left
+    # from before a restart
+    def run_retries(self):
+        while not self.stopped.wait(1):
+            due = self.query('SELECT id, chat, text, attempts FROM outbox '
+                             'WHERE next <= ? ORDER BY id', (time.time(),))
+            for oid, chat, text, attempts in due:
+                if oid not in self.inflight:
+                    self.stats['retried'] += 1
+                    self.submit(oid, chat, text, attempts)
+
+    def dead(self):
+        return [{'id': oid, 'chat': chat, 'attempts': attempts,
+                 'error': error, 'text': text[:60]}
+                for oid, chat, text, attempts, error
+                in self.query('SELECT id, chat, text, attempts, error '
+                              'FROM dead ORDER BY id')]
+
+    # moves dead letters back to the outbox, sent on the next retry pass
+    def requeue(self, ids):
+        self.write([op for oid in ids for op in [
+            ('INSERT INTO outbox SELECT id, chat, text, 0, 0, error '
+             'FROM dead WHERE id = ?', (oid,)),
+            ('DELETE FROM dead WHERE id = ?', (oid,))]])
+
+    def status(self):
+        depth, = self.query('SELECT COUNT(*) FROM outbox')[0]
+        dead, = self.query('SELECT COUNT(*) FROM dead')[0]
+        inbox, = self.query('SELECT COUNT(*) FROM inbox')[0]
+        return dict(self.stats, depth=depth, inflight=len(self.inflight),
+                    inbox=inbox, dead_letters=dead)
+
+    def start(self):
+        for target in [self.run_writer, self.run_retries]:
+            t = Thread(target=target, daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    # commits what's pending and stops
+    def stop(self):
+        self.stopped.set()
+        with self.cond:
+            self.cond.notify_all()
+        for t in self.threads:
+            t.join()
+        self.threads.clear()
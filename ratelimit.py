@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+
+import time
+
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Condition, Thread
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        # set from retry_after when telegram throttles us anyway
+        self.blocked = 0.0
+
+    # earliest monotonic time at which a token can be taken
+    def ready(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+        t = now if self.tokens >= 1 else now + (1 - self.tokens) / self.rate
+        return max(t, self.blocked)
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, until):
+        self.blocked = max(self.blocked, until)
+
+
+# outbound send scheduler with a global bucket and one bucket per chat.
+# chats are served round robin, and a chat that has no tokens left or a
+# send still in flight is skipped so it doesn't hold back the messages
+# queued for the others. up to `parallel` sends run at the same time, on a
+# thread pool, or without threads when `pooled` is False and send()
+# returns a future instead of the response
+class Scheduler:
+    def __init__(self, send, limits=None, parallel=1, retries=1, pooled=True):
+        limits = limits or {}
+        self.send = send
+        self.pooled = pooled
+        self.retries = limits.get('retries', 3)
+        self.error_retries = retries
+        self.parallel = parallel
+        self.pool = None
+        self.busy = set()
+        self.group_rate = limits.get('group', 20) / 60
+        self.private_rate = limits.get('private', 1)
+
+        rate = limits.get('global', 30)
+        self.bucket = TokenBucket(rate, rate)
+        self.buckets = {}
+
+        self.queues = OrderedDict()
+        self.cond = Condition()
+        self.running = False
+        self.thread = None
+        self.stats = {
+            'queued': 0,
+            'sent': 0,
+            'throttled': 0,
+            'retried': 0,
+            'failed': 0,
+            'delayed': 0,
+            'delay_total': 0.0
+        }
+
+    def chat_bucket(self, cid):
+        if cid not in self.buckets:
+            # negative ids and @names are groups and channels
+            if type(cid) is int and cid > 0:
+                self.buckets[cid] = TokenBucket(self.private_rate, 1)
+            else:
+                self.buckets[cid] = TokenBucket(self.group_rate, 3)
+        return self.buckets[cid]
+
+    def submit(self, cid, params):
+        job = {
+            'future': Future(),
+            'params': params,
+            'attempts': 0,
+            'queued': time.monotonic()
+        }
+
+        with self.cond:
+            self.queues.setdefault(cid, deque()).append(job)
+            self.stats['queued'] += 1
+            self.cond.notify_all()
+
+        return job['future']
+
+    def next_job(self):
+        with self.cond:
+            while self.running:
+                now = time.monotonic()
+                wake = None
+
+                if len(self.busy) >= self.parallel:
+                    self.cond.wait()
+                    continue
+
+                for cid, q in self.queues.items():
+                    if cid in self.busy:
+                        continue
+
+                    t = max(self.bucket.ready(now),
+                            self.chat_bucket(cid).ready(now))
+                    if t > now:
+                        wake = t if wake is None else min(wake, t)
+                        continue
+
+                    job = q.popleft()
+                    if q:
+                        self.queues.move_to_end(cid)
+                    else:
+                        del self.queues[cid]
+
+                    self.bucket.take()
+                    self.chat_bucket(cid).take()
+                    self.busy.add(cid)
+
+                    delay = now - job['queued']
+                    if delay > 1:
+                        self.stats['delayed'] += 1
+                    self.stats['delay_total'] += delay
+                    return cid, job
+
+                self.cond.wait(None if wake is None else wake - now)
+
+        return None, None
+
+    # whether a failed send goes back to the front of its chat's queue
+    def retry(self, cid, job, r):
+        code = r.get('error_code')
+
+        if code == 429:
+            self.stats['throttled'] += 1
+            retry_after = r.get('parameters', {}).get('retry_after', 1)
+            self.chat_bucket(cid).block(time.monotonic() + retry_after)
+            return job['attempts'] <= self.retries
+
+        # timeouts, connection errors and 5xx are worth another try
+        if not r.get('ok') and (not code or code >= 500):
+            return job['attempts'] <= self.error_retries
+
+        return False
+
+    def process(self, cid, job):
+        try:
+            r = self.send(job['params'])
+        except Exception as e:
+            r = {'ok': False, 'description': str(e)}
+
+        self.finish(cid, job, r)
+
+    def sent(self, cid, job, f):
+        try:
+            r = f.result()
+        except Exception as e:
+            r = {'ok': False, 'description': str(e)}
+
+        self.finish(cid, job, r)
+
+    def finish(self, cid, job, r):
+        job['attempts'] += 1
+
+        with self.cond:
+            self.busy.discard(cid)
+            self.cond.notify_all()
+
+            if self.retry(cid, job, r):
+                self.stats['retried'] += 1
+                self.queues.setdefault(cid, deque()).appendleft(job)
+                return
+
+            self.stats['sent' if r.get('ok') else 'failed'] += 1
+
+        job['future'].set_result(r)
+
+    def run(self):
+        while True:
+            cid, job = self.next_job()
+            if not job:
+                break
+
+            if self.pool:
+                self.pool.submit(self.process, cid, job)
+            else:
+                self.send(job['params']).add_done_callback(
+                    lambda f, cid=cid, job=job: self.sent(cid, job, f))
+
+    def status(self):
+        with self.cond:
+            pending = sum(len(q) for q in self.queues.values())
+        return dict(self.stats, pending=pending, inflight=len(self.busy),
+                    chats=len(self.buckets))
+
+    def start(self):
+        self.running = True
+        if self.pooled:
+            self.pool = ThreadPoolExecutor(self.parallel)
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # waits up to `timeout` seconds for the queued messages to go out
+    def drain(self, timeout):
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while (self.queues or self.busy) and time.monotonic() < deadline:
+                self.cond.wait(deadline - time.monotonic())
+
+    # messages still queued fail, so nobody waits on them forever
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.thread:
+            self.thread.join()
+        if self.pool:
+            self.pool.shutdown()
+
+        with self.cond:
+            left = [job for q in self.queues.values() for job in q]
+            self.queues.clear()
+        for job in left:
+            self.stats['failed'] += 1
+            job['future'].set_result({'ok': False,
+                                      'description': 'shutting down'})
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+
+# chat list from the state plus lookup indexes by id, name and by the
+# users owning or administering each chat. the list stays the one saved
+# in the state, so every change must go through add, remove or reindex
+class ChatRegistry:
+    def __init__(self, chats):
+        self.chats = chats
+        self.by_id = {}
+        self.by_name = {}
+        self.by_user = {}
+        # what each chat was indexed under, to undo it on changes
+        self.keys = {}
+
+        for c in chats:
+            self.index(c)
+
+    def __iter__(self):
+        return iter(self.chats)
+
+    def __len__(self):
+        return len(self.chats)
+
+    def users(self, c):
+        users = {a['id'] for a in c.get('admins', [])}
+        if 'owner' in c:
+            users.add(c['owner']['id'])
+        return users
+
+    def index(self, c):
+        name, users = c.get('name'), self.users(c)
+
+        self.by_id[c['id']] = c
+        if name is not None:
+            self.by_name.setdefault(name, c)
+        for u in users:
+            self.by_user.setdefault(u, {})[c['id']] = c
+
+        self.keys[c['id']] = (name, users)
+
+    def unindex(self, c):
+        name, users = self.keys.pop(c['id'], (None, set()))
+
+        self.by_id.pop(c['id'], None)
+        if self.by_name.get(name) is c:
+            del self.by_name[name]
+        for u in users:
+            self.by_user.get(u, {}).pop(c['id'], None)
+            if not self.by_user.get(u, True):
+                del self.by_user[u]
+
+    def get(self, cid):
+        return self.by_id.get(cid)
+
+    def named(self, name):
+        return self.by_name.get(name)
+
+    # chats where the user is owner or admin
+    def privileged(self, uid):
+        return list(self.by_user.get(uid, {}).values())
+
+    def add(self, c):
+        self.chats.append(c)
+        self.index(c)
+
+    def remove(self, c):
+        self.unindex(c)
+        self.chats.remove(c)
+
+    def reindex(self, c):
+        if c['id'] in self.by_id:
+            self.unindex(c)
+            self.index(c)
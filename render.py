@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+import re
+
+
+FENCE = '```'
+MORE = '\n\n...(truncated)'
+
+# escapes, code fences, inline code, links, bold and italics
+ENTITY = re.compile(r'\\.|```.*?(?:```|$)|`[^`]*`|\[[^\]]*\]\([^)]*\)'
+                    r'|\*[^*]*\*|_[^_]*_', re.S)
+
+
+# entity spans of the text as (start, end, is_fence), up to the first one
+# starting after `stop`
+def entities(text, stop=None):
+    spans = []
+    for m in ENTITY.finditer(text):
+        if stop is not None and m.start() > stop:
+            break
+        if not m.group().startswith('\\'):
+            spans.append((m.start(), m.end(), m.group().startswith(FENCE)))
+    return spans
+
+
+# best place to cut the text at or before `size`: a paragraph break, a
+# line break or a space, never inside an entity. breaks that would leave
+# the part less than half full are passed over. a code fence can be cut
+# at a line break, in which case it must be closed and reopened, and that
+# is reported with the second value
+def cut_point(text, size):
+    # an entity open at `size` only ends further on
+    spans = entities(text, size)
+
+    def inside(p):
+        for start, end, fence in spans:
+            if start < p < end:
+                return 'fence' if fence else 'entity'
+
+    for sep, floor in [('\n\n', size // 2), ('\n', size // 2), (' ', 0)]:
+        p = text.rfind(sep, 0, size)
+        while p > 0 and p + len(sep) >= floor:
+            where = inside(p + len(sep))
+            if not where or (where == 'fence' and sep != ' '):
+                return p + len(sep), where == 'fence'
+            p = text.rfind(sep, 0, p)
+
+    # one entity longer than the whole budget, cut before it if possible
+    where = [s for s in spans if s[0] < size < s[1]]
+    if where and where[0][0] > 0:
+        return where[0][0], False
+    return size, False
+
+
+# splits a message over Telegram's size limit into numbered parts
+def split(text, limit=4096, max_parts=10):
+    if len(text) <= limit:
+        return [text]
+
+    # room for the "(n/m)" line, for closing a fence and for the marker
+    # left when the parts run out
+    size = limit - len('(00/00)\n') - len('\n' + FENCE) - len(MORE)
+
+    parts = []
+    reopen = ''
+    while text and len(parts) < max_parts:
+        text = reopen + text
+        if len(text) <= size:
+            parts.append(text)
+            text = ''
+            break
+
+        p, fence = cut_point(text, size)
+        part, text = text[:p].rstrip('\n'), text[p:]
+        reopen = ''
+        if fence:
+            part += '\n' + FENCE
+            reopen = FENCE + '\n'
+        parts.append(part)
+
+    if text:
+        parts[-1] += MORE
+
+    return ['({0}/{1})\n{2}'.format(i + 1, len(parts), part)
+            for i, part in enumerate(parts)]
+
+
+# shortens a message over the limit at a safe point
+def truncate(text, limit=4096):
+    if len(text) <= limit:
+        return text
+
+    size = limit - len(MORE) - len('\n' + FENCE)
+    p, fence = cut_point(text, size)
+    return text[:p].rstrip('\n') + ('\n' + FENCE if fence else '') + MORE
+
+
+# characters a formatter may produce before it should stop rendering
+def budget(settings):
+    limit = settings.get('limit', 4096)
+    if settings.get('policy', 'split') == 'truncate':
+        return limit
+    return limit * settings.get('max_parts', 10)
+
+
+def render(text, settings):
+    limit = settings.get('limit', 4096)
+    if settings.get('policy', 'split') == 'truncate':
+        return [truncate(text, limit)]
+    return split(text, limit, settings.get('max_parts', 10))
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+from fnmatch import fnmatchcase
+
+
+# branch or tag name of a ref, which may itself contain slashes
+def ref_branch(ref):
+    for prefix in ['refs/heads/', 'refs/tags/']:
+        if ref.startswith(prefix):
+            return ref[len(prefix):]
+    return ref
+
+
+# project path and branch an event is about, None when it has none
+def event_route(event, data):
+    project = data.get('project', {}).get('path_with_namespace',
+                                          data.get('path_with_namespace'))
+    branch = None
+
+    if 'ref' in data:
+        branch = ref_branch(data['ref'])
+
+    elif event == 'repository_update' and len(data.get('changes', [])) == 1:
+        branch = ref_branch(data['changes'][0]['ref'])
+
+    elif event == 'merge_request':
+        branch = data['object_attributes']['target_branch']
+
+    elif 'merge_request' in data:
+        branch = data['merge_request'].get('target_branch')
+
+    return project, branch
+
+
+# routing table from event kind, project and branch to the chats that
+# subscribed to them. chats without subscriptions get every event.
+# rebuilt on the first lookup after invalidate()
+class Router:
+    def __init__(self, chats):
+        self.chats = chats
+        self.dirty = True
+        self.all = ()
+        self.kinds = {}
+        self.memo = {}
+
+    def invalidate(self):
+        self.dirty = True
+
+    def rebuild(self):
+        self.all = []
+        self.kinds = {}
+        self.memo = {}
+
+        for c in self.chats:
+            if not c['authorized'] or c['quiet']:
+                continue
+
+            if not c.get('subs'):
+                self.all.append(c['id'])
+                continue
+
+            for s in c['subs']:
+                kind = self.kinds.setdefault(s['kind'],
+                                             {'exact': {}, 'glob': []})
+                if any(ch in s['project'] for ch in '*?['):
+                    kind['glob'].append((s['project'], c['id'], s['branch']))
+                else:
+                    kind['exact'].setdefault(s['project'], [])\
+                        .append((c['id'], s['branch']))
+
+        self.all = tuple(self.all)
+        self.dirty = False
+
+    def match(self, kind, project, branch):
+        chats = set(self.all)
+
+        def branch_ok(b):
+            return b == '*' or (branch is not None and fnmatchcase(branch, b))
+
+        for k in [kind, '*']:
+            table = self.kinds.get(k)
+            if not table:
+                continue
+
+            for cid, b in table['exact'].get(project, []):
+                if branch_ok(b):
+                    chats.add(cid)
+
+            for p, cid, b in table['glob']:
+                if (p == '*' or (project is not None
+                                 and fnmatchcase(project, p)))\
+                   and branch_ok(b):
+                    chats.add(cid)
+
+        return tuple(sorted(chats))
+
+    # whether any chat may want events of this kind at all
+    def wants(self, kind):
+        if self.dirty:
+            self.rebuild()
+        return bool(self.all) or kind in self.kinds or '*' in self.kinds
+
+    # chat ids that must receive the event
+    def route(self, kind, project, branch):
+        if self.dirty:
+            self.rebuild()
+
+        key = (kind, project, branch)
+        if key not in self.memo:
+            if len(self.memo) > 4096:
+                self.memo.clear()
+            self.memo[key] = self.match(kind, project, branch)
+        return self.memo[key]
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+import json
+import os
+import sqlite3
+import time
+
+from threading import Lock
+
+
+# fields identifying a row for each list kept in the state
+KEYS = {
+    'owners': ('id',),
+    'chats': ('id',),
+    'otp': ('secret',),
+    'challenges': ('cid', 'uid')
+}
+
+
+def row_key(kind, o):
+    return json.dumps([o[f] for f in KEYS[kind]])
+
+
+# state kept inside config.json, rewritten whole but atomically
+class JsonStore:
+    def __init__(self, config_file, config):
+        self.configFile = config_file
+        self.config = config
+
+    def load(self):
+        return self.config.setdefault('state', {})
+
+    def save(self, state):
+        self.config['state'] = state
+        self.write()
+
+    def write(self):
+        tmp = self.configFile + '.tmp'
+        with open(tmp, 'w') as cf:
+            json.dump(self.config, cf, indent=2, sort_keys=False)
+            cf.write("\n")
+            cf.flush()
+            os.fsync(cf.fileno())
+        os.replace(tmp, self.configFile)
+
+    def compact(self):
+        pass
+
+
+# state kept in sqlite, one row per owner/chat/otp/challenge entry. only
+# the rows that changed since the last save are written. several replicas
+# may share the database, see lease()
+class SqliteStore:
+    def __init__(self, path, journal='WAL'):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode={0}'.format(journal))
+        self.db.execute('CREATE TABLE IF NOT EXISTS state ('
+                        'kind TEXT, key TEXT, data TEXT, '
+                        'PRIMARY KEY (kind, key))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS lease ('
+                        'name TEXT PRIMARY KEY, holder TEXT, expires REAL)')
+        self.db.commit()
+        # the connection is shared by the save, refresh and lease threads
+        self.lock = Lock()
+        # last written json of every row, to tell what changed
+        self.rows = {}
+
+    def empty(self):
+        with self.lock:
+            return not self.db.execute('SELECT 1 FROM state LIMIT 1')\
+                .fetchone()
+
+    def load(self):
+        state = {kind: [] for kind in KEYS}
+        rows = {}
+
+        with self.lock:
+            for kind, key, data in self.db.execute(
+                    'SELECT kind, key, data FROM state ORDER BY rowid'):
+                rows[(kind, key)] = data
+                if kind in KEYS:
+                    state[kind].append(json.loads(data))
+                else:
+                    state[key] = json.loads(data)
+            self.rows = rows
+
+        return state
+
+    def save(self, state):
+        rows = {}
+        for k, v in state.items():
+            if k in KEYS:
+                for o in v:
+                    rows[(k, row_key(k, o))] = json.dumps(o)
+            else:
+                rows[('value', k)] = json.dumps(v)
+
+        changed = [(kind, key, data) for (kind, key), data in rows.items()
+                   if self.rows.get((kind, key)) != data]
+        removed = [k for k in self.rows if k not in rows]
+
+        if not (changed or removed):
+            return
+
+        with self.lock, self.db:
+            self.db.executemany('INSERT INTO state (kind, key, data) '
+                                'VALUES (?, ?, ?) ON CONFLICT (kind, key) '
+                                'DO UPDATE SET data = excluded.data',
+                                changed)
+            self.db.executemany('DELETE FROM state WHERE kind = ? AND key = ?',
+                                removed)
+        self.rows = rows
+
+    def compact(self):
+        with self.lock:
+            self.db.execute('VACUUM')
+
+    # takes or renews the named lease for `ttl` seconds. True while it's
+    # held by `holder`, False when another holder's lease hasn't expired.
+    # BEGIN IMMEDIATE makes the check and the write one step across
+    # processes
+    def lease(self, holder, ttl, name='leader'):
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.db.execute('SELECT holder, expires FROM lease '
+                                      'WHERE name = ?', (name,)).fetchone()
+                if row and row[0] != holder and row[1] > now:
+                    self.db.rollback()
+                    return False
+
+                self.db.execute('INSERT INTO lease (name, holder, expires) '
+                                'VALUES (?, ?, ?) ON CONFLICT (name) '
+                                'DO UPDATE SET holder = excluded.holder, '
+                                'expires = excluded.expires',
+                                (name, holder, now + ttl))
+                self.db.commit()
+                return True
+            except Exception:
+                self.db.rollback()
+                raise
+
+    def release(self, holder, name='leader'):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM lease WHERE name = ? AND holder = ?',
+                            (name, holder))
+
+
+def open_store(config_file, config):
+    settings = config.get('store', {})
+
+    if settings.get('backend', 'sqlite') == 'json':
+        return JsonStore(config_file, config)
+
+    store = SqliteStore(settings.get('path', 'state.db'),
+                        settings.get('journal', 'WAL'))
+
+    # first start on sqlite: move the state section out of config.json
+    if 'state' in config:
+        if store.empty():
+            store.save(config['state'])
+            print('Migrated state from {0}'.format(config_file))
+
+        del config['state']
+        JsonStore(config_file, config).write()
+
+    return store
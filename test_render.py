@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+from render import ENTITY, split, truncate
+
+
+# every part must parse on its own: no entity may be left open
+def balanced(part):
+    rest = ENTITY.sub('', part.split('\n', 1)[1])
+    return not any(c in rest for c in '*_`[')
+
+
+def test_short_message_is_kept():
+    assert split('hello', 4096) == ['hello']
+
+
+def test_parts_fit_the_limit():
+    parts = split('word ' * 3000, 4096)
+    assert len(parts) == 4
+    assert all(len(p) <= 4096 for p in parts)
+
+
+def test_bold_across_the_cut_is_not_split():
+    text = 'a ' * 2000 + '*bold text that is long ' + 'x ' * 200 + 'end*'
+    parts = split(text, 4096)
+    assert len(parts) == 2
+    assert all(balanced(p) for p in parts)
+    assert parts[1].split('\n', 1)[1].startswith('*bold')
+
+
+def test_link_across_the_cut_is_not_split():
+    text = 'a ' * 2000 + '[link text that is long ' + 'x ' * 200 +\
+        'end](http://example.com)'
+    parts = split(text, 4096)
+    assert all(balanced(p) for p in parts)
+    assert parts[1].split('\n', 1)[1].startswith('[link')
+
+
+def test_fence_is_closed_and_reopened():
+    text = '```\n' + 'line of code\n' * 600 + '```'
+    parts = split(text, 4096)
+    assert len(parts) == 2
+    assert parts[0].endswith('```')
+    assert parts[1].split('\n', 1)[1].startswith('```\n')
+
+
+def test_small_paragraphs_dont_waste_parts():
+    text = 'header\n\n' + ''.join('\n[title](http://x)\n' + 'body ' * 810 + '\n'
+                                  for _ in range(40))
+    parts = split(text, 4096, 10)
+    assert all(len(p) > 2000 for p in parts[:-1])
+
+
+def test_truncate_keeps_entities_whole():
+    text = 'a ' * 2000 + '*bold text that is long ' + 'x ' * 200 + 'end*'
+    out = truncate(text, 4096)
+    assert len(out) <= 4096
+    assert out.count('*') % 2 == 0
@@ -6,10 +6,13 @@ import string
 import time
 
 from flask import json
+from json import JSONEncoder
 
 
 def digest(string):
-    return sha256(string.encode()).hexdigest()
+    if type(string) is str:
+        string = string.encode()
+    return sha256(string).hexdigest()
 
 
 # shortcut to json.dumps with friendlier formatting for lists and timestamps
@@ -26,6 +29,19 @@ def dumpjson(o):
     return json.dumps(o, indent=2)
 
 
+# the first `size` characters of the indented json, without encoding the
+# rest of a large object
+def headjson(o, size):
+    out = []
+    n = 0
+    for chunk in JSONEncoder(indent=2).iterencode(o):
+        out.append(chunk)
+        n += len(chunk)
+        if n > size:
+            break
+    return ''.join(out)
+
+
 # generate a secret
 def new_secret(length):
     charset = string.ascii_letters + string.digits
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+import asyncio
+import queue
+import time
+
+from concurrent.futures import TimeoutError
+from threading import Lock, Thread
+
+
+# bounded queue drained by a pool of worker threads
+class WorkQueue:
+    def __init__(self, handler, workers=4, size=1000):
+        self.handler = handler
+        self.workers = workers
+        self.queue = queue.Queue(size)
+        self.threads = []
+        self.lock = Lock()
+        self.stats = {
+            'enqueued': 0,
+            'rejected': 0,
+            'processed': 0,
+            'failed': 0,
+            'wait_last': 0.0,
+            'wait_max': 0.0,
+            'wait_total': 0.0
+        }
+
+    def put(self, *job):
+        try:
+            self.queue.put_nowait((time.monotonic(), job))
+        except queue.Full:
+            self.stats['rejected'] += 1
+            return False
+
+        self.stats['enqueued'] += 1
+        return True
+
+    def work(self):
+        while True:
+            queued, job = self.queue.get()
+            if job is None:
+                break
+
+            wait = time.monotonic() - queued
+            with self.lock:
+                self.stats['wait_last'] = wait
+                self.stats['wait_max'] = max(self.stats['wait_max'], wait)
+                self.stats['wait_total'] += wait
+
+            try:
+                self.handler(*job)
+                self.stats['processed'] += 1
+            except Exception as e:
+                self.stats['failed'] += 1
+                print('Work queue job failed: {0}'.format(e))
+            finally:
+                self.queue.task_done()
+
+    def status(self):
+        done = self.stats['processed'] + self.stats['failed']
+        return dict(self.stats,
+                    depth=self.queue.qsize(),
+                    workers=len(self.threads),
+                    wait_avg=self.stats['wait_total'] / done if done else 0.0)
+
+    def start(self):
+        for _ in range(self.workers):
+            t = Thread(target=self.work, daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    # finishes the queued jobs, for `timeout` seconds at most. whatever is
+    # left is dropped
+    def stop(self, timeout=None):
+        deadline = time.monotonic() + (timeout or 0)
+
+        def left():
+            return None if timeout is None\
+                else max(0, deadline - time.monotonic())
+
+        try:
+            for _ in self.threads:
+                self.queue.put((time.monotonic(), None), timeout=left())
+        except queue.Full:
+            pass
+
+        for t in self.threads:
+            t.join(left())
+        self.threads.clear()
+
+
+# the same queue drained by tasks on an event loop, for the asyncio bot.
+# the handler blocks, so each task runs it on the loop's executor
+class AsyncWorkQueue(WorkQueue):
+    def __init__(self, handler, loop, workers=4, size=1000):
+        super(AsyncWorkQueue, self).__init__(handler, workers, size)
+        self.loop = loop
+        self.queue = asyncio.run_coroutine_threadsafe(self.make_queue(size),
+                                                      loop).result()
+
+    # before python 3.10 a queue belongs to the loop it's created on
+    async def make_queue(self, size):
+        return asyncio.Queue(size)
+
+    # from another thread the job is handed over to the loop
+    def put(self, *job):
+        try:
+            on_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            on_loop = False
+
+        if not on_loop:
+            return asyncio.run_coroutine_threadsafe(self.offer(job),
+                                                    self.loop).result()
+        return self.offer_nowait(job)
+
+    async def offer(self, job):
+        return self.offer_nowait(job)
+
+    def offer_nowait(self, job):
+        try:
+            self.queue.put_nowait((time.monotonic(), job))
+        except asyncio.QueueFull:
+            self.stats['rejected'] += 1
+            return False
+
+        self.stats['enqueued'] += 1
+        return True
+
+    async def work(self):
+        while True:
+            queued, job = await self.queue.get()
+            if job is None:
+                break
+
+            wait = time.monotonic() - queued
+            self.stats['wait_last'] = wait
+            self.stats['wait_max'] = max(self.stats['wait_max'], wait)
+            self.stats['wait_total'] += wait
+
+            try:
+                await self.loop.run_in_executor(None, self.handler, *job)
+                self.stats['processed'] += 1
+            except Exception as e:
+                self.stats['failed'] += 1
+                print('Work queue job failed: {0}'.format(e))
+            finally:
+                self.queue.task_done()
+
+    def start(self):
+        for _ in range(self.workers):
+            self.threads.append(
+                asyncio.run_coroutine_threadsafe(self.work(), self.loop))
+
+    async def drain(self):
+        for _ in self.threads:
+            await self.queue.put((time.monotonic(), None))
+        await asyncio.gather(*map(asyncio.wrap_future, self.threads))
+
+    def stop(self, timeout=None):
+        try:
+            asyncio.run_coroutine_threadsafe(self.drain(), self.loop)\
+                .result(timeout)
+        except TimeoutError:
+            pass
+        self.threads.clear()